@@ -45,9 +45,15 @@ __author__ = supybot.authors.jemfinch
 # contributions.
 __contributors__ = {}
 
+import __builtin__
+
 import config
 import plugin
-reload(plugin) # In case we're being reloaded.
+# Whether the module we're replacing, if any, has the reload hook; see reload
+# below.
+hooked = hasattr(plugin, 'reload')
+# The builtin: once this module has been loaded, reload below shadows it.
+__builtin__.reload(plugin) # In case we're being reloaded.
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
 
@@ -57,5 +63,18 @@ if world.testing:
 Class = plugin.Class
 configure = config.configure
 
+if hooked:
+    def reload(version):
+        """Owner's reload command calls this once the new module is loaded,
+        with what plugin.reload returned before it was."""
+        plugin.expectWarmState(version)
+else:
+    # Owner only calls plugin.reload() when the module being replaced has
+    # it, but calls ours whenever there is one, and would fail for want of
+    # its argument.  So a reload from a version without the hook leaves
+    # both out, and the old instance closes everything as it would on
+    # unload.
+    globals().pop('reload', None)
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
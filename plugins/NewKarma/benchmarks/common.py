@@ -0,0 +1,123 @@
+###
+# Copyright (c) 2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Shared setup for the NewKarma benchmarks.  Importing this module puts the
+plugin directory on sys.path and moves into a scratch directory, where
+supybot keeps its data, logs and configuration, so the benchmarks never
+touch a real bot's databases or leave files behind.
+"""
+
+import os
+import sys
+import time
+import atexit
+import shutil
+import platform
+import tempfile
+
+pluginDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, pluginDir)
+
+try:
+    import json
+except ImportError:
+    import simplejson as json # for python2.5
+
+# supybot creates its directories relative to the current directory as soon
+# as it is imported.
+startDirectory = os.getcwd()
+directory = tempfile.mkdtemp(prefix='newkarma-bench-')
+os.chdir(directory)
+
+import supybot.conf as conf
+import supybot.log as log
+
+# Keep supybot's log messages out of the machine-readable output.
+conf.supybot.log.stdout.setValue(False)
+# Nothing of supybot's needs saving, and flushing it at exit would recreate
+# the scratch directory after tearDown() has removed it.
+conf.supybot.flush.setValue(False)
+
+def setUp():
+    conf.supybot.directories.data.setValue(os.path.join(directory, 'data'))
+    return directory
+
+def tearDown():
+    os.chdir(startDirectory)
+    shutil.rmtree(directory, True)
+
+# In case a benchmark dies before it gets to tearDown().
+atexit.register(tearDown)
+
+def path(filename):
+    """Returns filename, given on the command line, as an absolute path."""
+    return os.path.join(startDirectory, filename)
+
+def percentile(samples, p):
+    """Returns the p-th percentile of samples, which must be sorted."""
+    if not samples:
+        return None
+    i = int(round(p / 100.0 * (len(samples) - 1)))
+    return samples[i]
+
+def summarize(samples, elapsed=None):
+    """Summarizes a list of latencies, in seconds, as a dict suitable for
+    report()."""
+    samples = sorted(samples)
+    if elapsed is None:
+        elapsed = sum(samples)
+    d = {'count': len(samples),
+         'seconds': elapsed}
+    if elapsed:
+        d['ops_per_second'] = len(samples) / elapsed
+    for p in (50, 90, 99):
+        d['p%s_ms' % p] = percentile(samples, p) * 1000.0
+    d['max_ms'] = samples[-1] * 1000.0
+    return d
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return (time.time() - start, result)
+
+def report(name, results, out=None):
+    """Writes results as a single JSON document, so that runs made against
+    different commits can be compared mechanically."""
+    if out is None:
+        out = sys.stdout
+    doc = {'benchmark': name,
+           'python': platform.python_version(),
+           'platform': platform.platform(),
+           'time': time.time(),
+           'results': results}
+    out.write(json.dumps(doc, indent=2, sort_keys=True))
+    out.write('\n')
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
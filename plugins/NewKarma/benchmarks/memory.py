@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Measures how much memory the plugin's in-memory state takes per thing it
+tracks.
+
+A channel of --things things (one name in four capitalized) is written for
+the journal and sqlite3 backends, along with an alias table of --aliases
+aliases.  Each structure is then loaded in a process of its own, so that
+memory used and freed by anything else doesn't skew its numbers, and
+reported in bytes per thing (or alias):
+
+  rss     -- how much the process grew, from /proc/self/statm, or from the
+             peak RSS where that isn't available.
+  objects -- the sum of sys.getsizeof over every object reachable from the
+             structure, which leaves out the allocator's overhead but doesn't
+             vary from run to run.
+
+Usage: memory.py [--things N] [--aliases N] [--seed N]
+"""
+
+import gc
+import sys
+import array
+import random
+import optparse
+import resource
+import multiprocessing
+
+import common
+
+import plugin
+import storage
+
+def rss():
+    try:
+        fd = file('/proc/self/statm')
+        try:
+            return int(fd.read().split()[1]) * resource.getpagesize()
+        finally:
+            fd.close()
+    except EnvironmentError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def objectSize(root):
+    """Returns the total sys.getsizeof of root and everything reachable from
+    it through containers, instance attributes and slots, counting shared
+    objects once."""
+    seen = set()
+    todo = [root]
+    total = 0
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.iterkeys())
+            todo.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            todo.extend(obj)
+        elif isinstance(obj, (str, unicode, int, long, float, array.array)):
+            pass
+        else:
+            if hasattr(obj, '__dict__'):
+                todo.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for slot in getattr(cls, '__slots__', ()):
+                    if hasattr(obj, slot):
+                        todo.append(getattr(obj, slot))
+    return total
+
+def karmaRows(n, r):
+    for (i, (name, added, subtracted)) in enumerate(storage.karmaRows(n, r)):
+        if i % 4:
+            name = name.lower()
+        yield (name, added, subtracted)
+
+def run(f, *args):
+    """Returns f(*args), called in a child process."""
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=lambda: queue.put(f(*args)))
+    child.start()
+    child.join()
+    if child.exitcode:
+        raise SystemExit('%s failed.' % f.__name__)
+    return queue.get()
+
+def populate(channel, options):
+    for (backend, (cls, filename)) in storage.backends.iteritems():
+        db = cls(filename)
+        try:
+            r = random.Random('%s-%s' % (options.seed, backend))
+            db.loadRows(channel, karmaRows(options.things, r))
+        finally:
+            db.close()
+    db = plugin.SqliteAliasDB('KarmaAliases.sqlite3.db')
+    try:
+        r = random.Random('%s-aliases' % options.seed)
+        db.loadRows(channel, storage.aliasRows(options.aliases, r))
+    finally:
+        db.close()
+
+def measure(n, f, *args):
+    """Calls f(*args), which returns the structure it loaded, and reports
+    its size per one of the n things in it."""
+    gc.collect()
+    before = rss()
+    (seconds, obj) = common.timed(f, *args)
+    gc.collect()
+    grown = rss() - before
+    return {'count': n,
+            'load_seconds': seconds,
+            'rss_bytes': grown,
+            'rss_bytes_per_thing': float(grown) / n,
+            'object_bytes_per_thing': float(objectSize(obj)) / n}
+
+def journalRecords(channel, options):
+    db = plugin.JournalKarmaDB(storage.backends['journal'][1])
+    try:
+        return measure(options.things, lambda: db._getDb(channel).records)
+    finally:
+        db.close()
+
+def journalDistribution(channel, options):
+    db = plugin.JournalKarmaDB(storage.backends['journal'][1])
+    try:
+        journal = db._getDb(channel)
+        return measure(options.things, journal.getDistribution)
+    finally:
+        db.close()
+
+def sqliteDistribution(channel, options):
+    db = plugin.SqliteKarmaDB(storage.backends['sqlite3'][1])
+    try:
+        return measure(options.things, db._getDistribution, channel)
+    finally:
+        db.close()
+
+def aliasClosure(channel, options):
+    db = plugin.SqliteAliasDB('KarmaAliases.sqlite3.db')
+    try:
+        return measure(options.aliases, db._getClosure, channel)
+    finally:
+        db.close()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--things', type='int', default=1000000,
+                      help='Things in the channel.')
+    parser.add_option('--aliases', type='int', default=100000,
+                      help='Aliases in the channel.')
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+    common.setUp()
+    channel = '#memory'
+    try:
+        run(populate, channel, options)
+        results = {'things': options.things, 'aliases': options.aliases,
+                   'seed': options.seed}
+        for (name, f) in (('journal_records', journalRecords),
+                          ('journal_distribution', journalDistribution),
+                          ('sqlite3_distribution', sqliteDistribution),
+                          ('alias_closure', aliasClosure)):
+            results[name] = run(f, channel, options)
+        common.report('memory', results)
+    finally:
+        common.tearDown()
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Replays channel traffic through a real bot with NewKarma loaded and measures
+how long each karma change takes to be answered.
+
+A stand-in IRC server is started on 127.0.0.1, and a supybot process is
+started against it with a scratch configuration: NewKarma loaded, replies
+on, unaddressed karma allowed, rate limits and supybot's outgoing throttle
+off.  Once the bot has joined, traffic is played into the channel at each
+rate given with --rates (lines per second, chatter included) for --duration
+seconds.  Every karma change gets exactly one reply from the bot, in order,
+so the latency of each is the time from the server sending the line to the
+server receiving the matching reply.
+
+Stepping stops at the first rate the bot can't keep up with: replies fall
+behind the offered rate by more than 5%, or the 90th percentile latency
+goes over --max-lag.  Finally --flood lines are sent all at once, and the
+rate at which their replies come back is the saturation throughput.
+
+Traffic is synthetic unless --log names a ChannelLogger log, whose messages
+are replayed in order (looping if needed).  Lines with alias phrases are
+left out, since they don't get one reply per change.
+
+Usage: replay.py [--rates 10,50,100,200,500] [--duration N] [--flood N]
+                 [--log FILE] [--database sqlite3] [--supybot PATH]
+"""
+
+import os
+import sys
+import time
+import random
+import socket
+import optparse
+import threading
+import subprocess
+import collections
+
+import common
+
+import plugin
+import rebuild
+
+class StandInServer(object):
+    """Just enough of an IRC server for one bot in one channel: it registers
+    the bot, lets it join with the replay's nicks already present, answers
+    its PINGs and hands everything it says to onReply."""
+    def __init__(self, channel, users):
+        self.channel = channel
+        self.users = users
+        self.nick = None
+        self.conn = None
+        self.joined = threading.Event()
+        self.lock = threading.Lock()
+        self.onReply = None
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # supybot sets a default timeout for every socket; we want none.
+        self.listener.settimeout(None)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def send(self, line):
+        self.lock.acquire()
+        try:
+            self.conn.sendall(line + '\r\n')
+        finally:
+            self.lock.release()
+
+    def say(self, nick, text):
+        self.send(':%s!%s@replay.invalid PRIVMSG %s :%s' %
+                  (nick, nick, self.channel, text))
+
+    def serve(self):
+        (self.conn, _) = self.listener.accept()
+        self.conn.settimeout(None)
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        inbuf = ''
+        while True:
+            data = self.conn.recv(65536)
+            if not data:
+                return
+            now = time.time()
+            inbuf += data
+            lines = inbuf.split('\n')
+            inbuf = lines.pop()
+            for line in lines:
+                self.handle(line.rstrip('\r'), now)
+
+    def handle(self, line, now):
+        (command, _, rest) = line.partition(' ')
+        command = command.upper()
+        if command == 'NICK':
+            self.nick = rest.lstrip(':')
+        elif command == 'USER':
+            self.send(':replay.invalid 001 %s :Welcome' % self.nick)
+            self.send(':replay.invalid 376 %s :End of MOTD' % self.nick)
+        elif command == 'PING':
+            self.send(':replay.invalid PONG %s' % rest)
+        elif command == 'JOIN':
+            self.send(':%s!bot@replay.invalid JOIN %s' %
+                      (self.nick, self.channel))
+            names = ' '.join([self.nick] + list(self.users))
+            self.send(':replay.invalid 353 %s = %s :%s' %
+                      (self.nick, self.channel, names))
+            self.send(':replay.invalid 366 %s %s :End of NAMES' %
+                      (self.nick, self.channel))
+            self.joined.set()
+        elif command == 'WHO':
+            self.send(':replay.invalid 315 %s %s :End of WHO' %
+                      (self.nick, rest.split()[0]))
+        elif command in ('PRIVMSG', 'NOTICE'):
+            if self.onReply is not None:
+                self.onReply(now, rest.partition(' :')[2])
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.listener.close()
+
+def writeConfig(directory, port, channel, options):
+    pluginsDir = os.path.dirname(common.pluginDir)
+    settings = [
+        ('supybot.nick', options.nick),
+        ('supybot.networks', 'replay'),
+        ('supybot.networks.replay.servers', '127.0.0.1:%s' % port),
+        ('supybot.networks.replay.channels', channel),
+        ('supybot.directories.conf', os.path.join(directory, 'conf')),
+        ('supybot.directories.data', os.path.join(directory, 'data')),
+        ('supybot.directories.data.tmp', os.path.join(directory, 'tmp')),
+        ('supybot.directories.backup', os.path.join(directory, 'backup')),
+        ('supybot.directories.log', os.path.join(directory, 'logs')),
+        ('supybot.directories.plugins', pluginsDir),
+        ('supybot.log.stdout', 'False'),
+        ('supybot.databases', options.database),
+        ('supybot.protocols.irc.throttleTime', '0'),
+        ('supybot.reply.whenNotCommand', 'False'),
+        ('supybot.plugins', 'NewKarma'),
+        ('supybot.plugins.NewKarma', 'True'),
+        ('supybot.plugins.NewKarma.response', 'True'),
+        ('supybot.plugins.NewKarma.allowUnaddressedKarma', 'True'),
+        ('supybot.plugins.NewKarma.rateLimit.nick.rate', '0'),
+        ('supybot.plugins.NewKarma.rateLimit.target.rate', '0'),
+        ('supybot.plugins.NewKarma.rateLimit.channel.rate', '0'),
+        ]
+    filename = os.path.join(directory, 'replay.conf')
+    fd = file(filename, 'w')
+    try:
+        for (name, value) in settings:
+            fd.write('%s: %s\n' % (name, value))
+    finally:
+        fd.close()
+    return filename
+
+def synthetic(r, users, things, chatter):
+    """Yields (nick, text) forever: karma for a long-tailed set of things,
+    sometimes with a reason, mixed with a fraction chatter of plain lines."""
+    while True:
+        nick = r.choice(users)
+        if r.random() < chatter:
+            yield (nick, 'just chatting about thing%d' % r.randrange(things))
+            continue
+        thing = 'thing%d' % (int(r.paretovariate(1.2)) % things)
+        text = thing + r.choice(['++', '++', '++', '--'])
+        if r.random() < 0.2:
+            text += ' for being helpful'
+        yield (nick, text)
+
+def recorded(filename):
+    """Returns the (nick, text) of every message in a ChannelLogger log."""
+    messages = []
+    fd = file(filename)
+    try:
+        for line in fd:
+            m = rebuild.messageRe.match(line.rstrip('\r\n'))
+            if m is None:
+                continue
+            text = m.group('text').rstrip()
+            if 'is also known as' in text or 'is no longer known as' in text:
+                continue
+            messages.append((m.group('nick'), text))
+    finally:
+        fd.close()
+    return messages
+
+def looped(messages):
+    while True:
+        for message in messages:
+            yield message
+
+class Replay(object):
+    def __init__(self, server, traffic, users):
+        self.server = server
+        self.traffic = traffic
+        self.users = users
+        # Send times of the karma changes still waiting for their reply.
+        self.expected = collections.deque()
+        self.latencies = []
+        self.lastReply = None
+        self.unexpected = 0
+        server.onReply = self.reply
+
+    def reply(self, now, text):
+        try:
+            sent = self.expected.popleft()
+        except IndexError:
+            self.unexpected += 1
+            return
+        self.latencies.append(now - sent)
+        self.lastReply = now
+
+    def play(self, n, rate=None):
+        """Sends n lines, rate per second or as fast as possible, and
+        returns how many karma changes they made."""
+        changes = 0
+        start = time.time()
+        for i in xrange(n):
+            if rate:
+                delay = start + float(i) / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            (nick, text) = self.traffic.next()
+            now = time.time()
+            # The reply can beat us back from sendall, so count it first.
+            k = len(plugin.parseKarma(text, self.users))
+            self.expected.extend([now] * k)
+            changes += k
+            self.server.say(nick, text)
+        return changes
+
+    def drain(self, timeout):
+        deadline = time.time() + timeout
+        while self.expected and time.time() < deadline:
+            time.sleep(0.01)
+        missing = len(self.expected)
+        self.expected.clear()
+        return missing
+
+    def phase(self, n, rate, timeout):
+        self.latencies = []
+        self.lastReply = None
+        start = time.time()
+        changes = self.play(n, rate)
+        sent = time.time() - start
+        missing = self.drain(timeout)
+        result = {'lines': n, 'changes': changes, 'missing': missing,
+                  'send_seconds': sent}
+        if rate:
+            result['offered_lines_per_second'] = rate
+        if self.latencies:
+            result.update(common.summarize(self.latencies,
+                                           self.lastReply - start))
+        return result
+
+def findSupybot():
+    path = os.path.join(os.path.dirname(sys.executable), 'supybot')
+    if os.path.exists(path):
+        return path
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, 'supybot')
+        if os.path.exists(path):
+            return path
+    return None
+
+def rates(s):
+    return [int(x) for x in s.split(',') if x]
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--rates', default='10,50,100,200,500,1000',
+                      help='Comma-separated lines per second to step '
+                           'through.')
+    parser.add_option('--duration', type='float', default=10.0,
+                      help='Seconds to play each rate for.')
+    parser.add_option('--flood', type='int', default=2000,
+                      help='Lines to send at once for the saturation '
+                           'throughput; 0 skips it.')
+    parser.add_option('--max-lag', type='float', default=1.0, dest='maxLag',
+                      help='90th percentile latency, in seconds, above '
+                           'which the bot counts as lagging.')
+    parser.add_option('--drain', type='float', default=30.0,
+                      help='Seconds to wait for outstanding replies after '
+                           'each phase.')
+    parser.add_option('--log', default=None,
+                      help='ChannelLogger log to replay instead of '
+                           'synthetic traffic.')
+    parser.add_option('--users', type='int', default=50)
+    parser.add_option('--things', type='int', default=5000)
+    parser.add_option('--chatter', type='float', default=0.5,
+                      help='Fraction of synthetic lines without karma.')
+    parser.add_option('--database', default='sqlite3',
+                      help='Karma backend, as in supybot.databases.')
+    parser.add_option('--nick', default='karmabot')
+    parser.add_option('--supybot', default=None,
+                      help='Path to the supybot script.')
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+    script = options.supybot or findSupybot()
+    if script is None:
+        parser.error('supybot not found; use --supybot.')
+    channel = '#replay'
+    if options.log:
+        messages = recorded(common.path(options.log))
+        if not messages:
+            parser.error('no messages in %s.' % options.log)
+        users = sorted(set([nick for (nick, _) in messages]))
+        traffic = looped(messages)
+    else:
+        users = ['user%d' % i for i in range(options.users)]
+        traffic = synthetic(random.Random(options.seed), users,
+                            options.things, options.chatter)
+    # The bot gets a directory of its own inside the scratch one.
+    directory = os.path.join(common.setUp(), 'bot')
+    os.mkdir(directory)
+    server = StandInServer(channel, users)
+    bot = None
+    try:
+        conffile = writeConfig(directory, server.port, channel, options)
+        output = file(os.path.join(directory, 'bot.out'), 'w')
+        start = time.time()
+        command = [sys.executable, script, conffile]
+        if os.getuid() == 0:
+            command.append('--allow-root')
+        bot = subprocess.Popen(command,
+                               stdout=output, stderr=subprocess.STDOUT,
+                               cwd=directory)
+        server.joined.wait(60)
+        if not server.joined.isSet():
+            output.close()
+            sys.stderr.write('The bot never joined:\n')
+            sys.stderr.write(file(output.name).read())
+            sys.exit(1)
+        results = {'database': options.database,
+                   'traffic': options.log and 'recorded' or 'synthetic',
+                   'join_seconds': time.time() - start,
+                   'phases': []}
+        # Let the bot finish its post-join chatter (WHO, MODE) first.
+        time.sleep(1)
+        replay = Replay(server, traffic, users)
+        sustained = None
+        for rate in rates(options.rates):
+            n = int(rate * options.duration)
+            result = replay.phase(n, rate, options.drain)
+            results['phases'].append(result)
+            changesPerSecond = result['changes'] / options.duration
+            keepingUp = result['missing'] == 0 and \
+                        result.get('ops_per_second', 0) >= \
+                        0.95 * changesPerSecond and \
+                        result.get('p90_ms', 0) <= options.maxLag * 1000
+            if not keepingUp:
+                break
+            sustained = rate
+        results['sustained_lines_per_second'] = sustained
+        if options.flood:
+            flood = replay.phase(options.flood, None, options.drain)
+            results['flood'] = flood
+            results['saturation_changes_per_second'] = \
+                flood.get('ops_per_second')
+        results['unexpected_replies'] = replay.unexpected
+        common.report('replay', results)
+    finally:
+        if bot is not None and bot.poll() is None:
+            os.kill(bot.pid, 15)
+            bot.wait()
+        server.close()
+        common.tearDown()
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Measures how long the plugin takes to load, and how long the first karma
+change in each channel takes afterwards, compared with later ones.
+
+--channels channels are filled with --things things and --aliases aliases
+each.  The plugin is then loaded into an in-process Irc, and a karma change
+is fed to it in every channel, timing the first one per channel and then
+--ops more.  The same is measured after a reload done the way Owner's reload
+command does it (the stores' connections are handed from the old instance to
+the new one), and after an unload followed by a load, which starts from closed
+stores as a restart would.
+
+Usage: startup.py [--channels N] [--things N] [--aliases N] [--ops N]
+                  [--backend sqlite3|journal] [--seed N]
+"""
+
+import os
+import gc
+import sys
+import random
+import optparse
+
+import common
+
+import supybot.conf as conf
+import supybot.plugin as plugin
+import supybot.irclib as irclib
+import supybot.ircmsgs as ircmsgs
+
+import config # registers the plugin's settings
+import storage
+
+name = os.path.basename(common.pluginDir)
+
+def configure(backend):
+    conf.registerNetwork('bench')
+    # Replies are drained straight away, so don't hold them back.
+    conf.supybot.protocols.irc.throttleTime.setValue(0)
+    conf.supybot.databases.setValue([backend, 'sqlite3'])
+    conf.supybot.directories.plugins.setValue(
+        [os.path.dirname(common.pluginDir)])
+    group = conf.supybot.plugins.NewKarma
+    group.response.setValue(True)
+    group.allowUnaddressedKarma.setValue(True)
+    for kind in ('nick', 'target', 'channel'):
+        group.rateLimit.get(kind).rate.setValue(0)
+
+def populate(backend, channels, options, r):
+    (cls, filename) = storage.backends[backend]
+    karmaDb = cls(filename)
+    aliasDb = storage.plugin.SqliteAliasDB('KarmaAliases.sqlite3.db')
+    try:
+        for channel in channels:
+            karmaDb.loadRows(channel, storage.karmaRows(options.things, r))
+            aliasDb.loadRows(channel, storage.aliasRows(options.aliases, r))
+    finally:
+        karmaDb.close()
+        aliasDb.close()
+
+def drain(irc):
+    n = 0
+    while irc.takeMsg() is not None:
+        n += 1
+    return n
+
+def feed(irc, channel, thing):
+    msg = ircmsgs.privmsg(channel, thing + '++', prefix='bench!bench@bench')
+    (elapsed, _) = common.timed(irc.feedMsg, msg)
+    assert drain(irc), 'no reply to %r' % msg.args[1]
+    return elapsed
+
+def events(irc, channels, options, r):
+    """Returns the latency of the first karma change in each channel and a
+    summary of the --ops changes after those."""
+    def thing():
+        if r.random() < 0.5:
+            return 'alias%d' % r.randrange(options.aliases)
+        return 'thing%d' % r.randrange(options.things)
+    first = [feed(irc, channel, thing()) for channel in channels]
+    latencies = [feed(irc, r.choice(channels), thing())
+                 for _ in xrange(options.ops)]
+    return {'first': common.summarize(first),
+            'steady': common.summarize(latencies)}
+
+def load(irc):
+    module = plugin.loadPluginModule(name)
+    return plugin.loadPluginClass(irc, module)
+
+def reload(irc):
+    """Reloads the plugin in the same order as Owner's reload command, hooks
+    included, so the old instance dies after the new module is loaded."""
+    callbacks = irc.removeCallback(name)
+    x = sys.modules[callbacks[0].__module__].reload()
+    module = plugin.loadPluginModule(name)
+    module.reload(x)
+    for callback in callbacks:
+        callback.die()
+    del callbacks
+    gc.collect()
+    return plugin.loadPluginClass(irc, module)
+
+def unload(irc):
+    for callback in irc.removeCallback(name):
+        callback.die()
+    gc.collect()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--backend', choices=storage.backends.keys(),
+                      default='sqlite3')
+    parser.add_option('--channels', type='int', default=20)
+    parser.add_option('--things', type='int', default=10000,
+                      help='Things in each channel.')
+    parser.add_option('--aliases', type='int', default=1000,
+                      help='Aliases in each channel.')
+    parser.add_option('--ops', type='int', default=1000,
+                      help='Karma changes timed after the first ones.')
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+    common.setUp()
+    try:
+        r = random.Random(options.seed)
+        channels = ['#startup%d' % i for i in xrange(options.channels)]
+        populate(options.backend, channels, options, r)
+        configure(options.backend)
+        irc = irclib.Irc('bench')
+        drain(irc)
+        results = {'backend': options.backend, 'seed': options.seed,
+                   'channels': options.channels, 'things': options.things,
+                   'aliases': options.aliases, 'ops': options.ops}
+        phases = (('cold', load), ('reload', reload),
+                  ('unload_load', lambda irc: (unload(irc), load(irc))))
+        for (phase, f) in phases:
+            (seconds, _) = common.timed(f, irc)
+            results[phase] = events(irc, channels, options, r)
+            results[phase]['load_seconds'] = seconds
+        unload(irc)
+        common.report('startup', results)
+    finally:
+        common.tearDown()
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Times every public method of the karma and alias stores against synthetic
+channels.
+
+For each size given with --sizes, a channel of that many things is loaded
+(totals follow a long-tailed distribution, as in real channels), and then
+each method is called repeatedly on random things.  Cheap lookups are timed
+--ops times, methods that scan the whole channel (rank, most, stats, ...)
+and applyChanges (with --batch changes a call) --scan-ops times, and
+dump/load --bulk-ops times.  The same is done for alias tables of each size
+given with --aliases, a fifth of whose aliases point at other aliases.
+
+The data is generated from --seed, so two runs with the same options work
+on the same channels.
+
+Usage: storage.py [--backend sqlite3|journal] [--sizes 1000,100000,10000000]
+                  [--aliases 100,10000] [--ops N] [--scan-ops N]
+                  [--bulk-ops N] [--batch N] [--seed N]
+"""
+
+import os
+import time
+import random
+import shutil
+import optparse
+
+import common
+
+import supybot.conf as conf
+import supybot.plugins as plugins
+
+import config # registers the plugin's settings
+import plugin
+
+backends = {'sqlite3': (plugin.SqliteKarmaDB, 'Karma.sqlite3.db'),
+            'journal': (plugin.JournalKarmaDB, 'Karma.journal.db')}
+
+def karmaRows(n, r):
+    for i in xrange(n):
+        added = int(r.paretovariate(1.5))
+        subtracted = int(r.paretovariate(2.5)) - 1
+        yield ('Thing%d' % i, added, subtracted)
+
+def aliasRows(n, r):
+    for i in xrange(n):
+        if i and r.random() < 0.1:
+            # Another name for an alias we already have, like "team".
+            alias = 'alias%d' % r.randrange(i)
+        else:
+            alias = 'alias%d' % i
+        if i and r.random() < 0.2:
+            name = 'alias%d' % r.randrange(i)
+        else:
+            name = 'Thing%d' % r.randrange(n)
+        yield (name, alias)
+
+def repeat(n, f, *args):
+    """Calls f(*args) n times and summarizes the latencies.  args may
+    contain callables, which are called afresh for each call."""
+    latencies = []
+    start = time.time()
+    for _ in xrange(n):
+        actual = []
+        for arg in args:
+            if callable(arg):
+                arg = arg()
+            actual.append(arg)
+        t0 = time.time()
+        f(*actual)
+        latencies.append(time.time() - t0)
+    return common.summarize(latencies, time.time() - start)
+
+def removeChannel(filename, channel):
+    shutil.rmtree(os.path.dirname(plugins.makeChannelFilename(filename,
+                                                              channel)),
+                  True)
+
+def benchKarma(backend, size, options, r):
+    (cls, filename) = backends[backend]
+    channel = '#karma%d' % size
+    db = cls(filename)
+    ranking = conf.supybot.plugins.NewKarma.rankingDisplay()
+    mostDisplay = conf.supybot.plugins.NewKarma.mostDisplay()
+    results = {}
+    try:
+        (results['populate_seconds'], _) = \
+            common.timed(db.loadRows, channel, karmaRows(size, r))
+        def existing():
+            return 'thing%d' % r.randrange(size)
+        def anything():
+            # One lookup in ten misses.
+            return 'thing%d' % r.randrange(size + size // 9)
+        def several():
+            return [anything() for _ in range(5)]
+        results['get'] = repeat(options.ops, db.get, channel, anything)
+        results['gets'] = repeat(options.ops, db.gets, channel, several)
+        results['top'] = repeat(options.scanOps, db.top, channel, ranking)
+        results['bottom'] = repeat(options.scanOps, db.bottom, channel,
+                                   ranking)
+        results['rank'] = repeat(options.scanOps, db.rank, channel,
+                                 lambda: 'Thing%d' % r.randrange(size))
+        results['size'] = repeat(options.scanOps, db.size, channel)
+        for kind in ('increased', 'decreased', 'active'):
+            results['most_' + kind] = repeat(options.scanOps, db.most,
+                                             channel, kind, mostDisplay)
+        results['increment'] = repeat(options.ops, db.increment, channel,
+                                      anything)
+        results['decrement'] = repeat(options.ops, db.decrement, channel,
+                                      anything)
+        def batch():
+            return [(anything(), r.choice((1, -1)))
+                    for _ in xrange(options.batch)]
+        results['applyChanges'] = repeat(options.scanOps, db.applyChanges,
+                                         channel, batch)
+        results['clear'] = repeat(options.ops, db.clear, channel, existing)
+        results['garbageCollect'] = repeat(options.ops, db.garbageCollect,
+                                           channel, existing)
+        (results['stats_first_seconds'], _) = common.timed(db.stats, channel)
+        results['stats'] = repeat(options.scanOps, db.stats, channel)
+        results['increment_with_stats'] = repeat(options.ops, db.increment,
+                                                 channel, anything)
+        dumpfile = 'bench-karma.csv'
+        results['dump'] = repeat(options.bulkOps, db.dump, channel, dumpfile)
+        results['load'] = repeat(options.bulkOps, db.load, channel, dumpfile)
+        os.remove(conf.supybot.directories.data.dirize(dumpfile))
+    finally:
+        db.close()
+        removeChannel(filename, channel)
+    return results
+
+def benchAliases(size, options, r):
+    channel = '#aliases%d' % size
+    filename = 'KarmaAliases.sqlite3.db'
+    db = plugin.SqliteAliasDB(filename)
+    results = {}
+    try:
+        (results['populate_seconds'], _) = \
+            common.timed(db.loadRows, channel, aliasRows(size, r))
+        (results['closure_build_seconds'], _) = \
+            common.timed(db.get, channel, 'alias0')
+        def anyAlias():
+            return 'alias%d' % r.randrange(size + size // 9)
+        def anyThing():
+            return 'thing%d' % r.randrange(size)
+        results['get'] = repeat(options.ops, db.get, channel, anyAlias)
+        results['get_aliases'] = repeat(options.ops, db.get_aliases, channel,
+                                        anyThing)
+        results['alias'] = repeat(options.ops, db.alias, channel,
+                                  anyThing, anyAlias)
+        results['unalias'] = repeat(options.ops, db.unalias, channel,
+                                    anyThing, anyAlias)
+        dumpfile = 'bench-aliases.csv'
+        results['dump'] = repeat(options.bulkOps, db.dump, channel, dumpfile)
+        # Loading drops the closure, so the first get after it pays for the
+        # rebuild.
+        def load():
+            db.load(channel, dumpfile)
+            db.get(channel, 'alias0')
+        results['load'] = repeat(options.bulkOps, load)
+        os.remove(conf.supybot.directories.data.dirize(dumpfile))
+    finally:
+        db.close()
+        removeChannel(filename, channel)
+    return results
+
+def sizes(s):
+    return [int(x) for x in s.split(',') if x]
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--backend', choices=backends.keys(),
+                      default='sqlite3')
+    parser.add_option('--sizes', default='1000,10000,100000',
+                      help='Comma-separated channel sizes, in things.')
+    parser.add_option('--aliases', default='100,1000,10000',
+                      help='Comma-separated alias table sizes.')
+    parser.add_option('--ops', type='int', default=1000)
+    parser.add_option('--scan-ops', type='int', default=50, dest='scanOps')
+    parser.add_option('--bulk-ops', type='int', default=3, dest='bulkOps')
+    parser.add_option('--batch', type='int', default=50,
+                      help='Changes per applyChanges call.')
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+    common.setUp()
+    try:
+        results = {'backend': options.backend, 'seed': options.seed,
+                   'ops': options.ops, 'scan_ops': options.scanOps,
+                   'bulk_ops': options.bulkOps, 'batch': options.batch,
+                   'karma': {}, 'aliases': {}}
+        for size in sizes(options.sizes):
+            r = random.Random('%s-karma-%s' % (options.seed, size))
+            results['karma'][str(size)] = benchKarma(options.backend, size,
+                                                     options, r)
+        for size in sizes(options.aliases):
+            r = random.Random('%s-aliases-%s' % (options.seed, size))
+            results['aliases'][str(size)] = benchAliases(size, options, r)
+        common.report('storage', results)
+    finally:
+        common.tearDown()
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -66,6 +66,41 @@ conf.registerChannelValue(conf.supybot.plugins.NewKarma, 'karmaMessageDown',
     message appears when USER loses a point of karma."""))
 conf.registerChannelValue(conf.supybot.plugins.NewKarma, 'karmaMessageNone',
     registry.String('USER has hit rock bottom with TOTAL points of karma.  Dropping USER like a bad habit.', """Determines what message appears if the USER hists a TOTAL of 0 karma points."""))
+conf.registerGlobalValue(conf.supybot.plugins.NewKarma, 'storageSocket',
+    registry.String('', """Determines the Unix socket the karmad storage
+    daemon listens on, for use when supybot.databases selects the karmad
+    backend.  If empty, karmad.sock in the bot's data directory is used."""))
+conf.registerGroup(conf.supybot.plugins.NewKarma, 'rateLimit')
+conf.registerChannelValue(conf.supybot.plugins.NewKarma.rateLimit, 'fold',
+    registry.Boolean(False, """Determines whether karma changes over the rate
+    limits are folded into a single deferred update (applied
+    supybot.plugins.NewKarma.rateLimit.foldDelay seconds later, without a
+    reply) instead of being dropped."""))
+conf.registerChannelValue(conf.supybot.plugins.NewKarma.rateLimit, 'foldDelay',
+    registry.PositiveInteger(60, """Determines how many seconds folded karma
+    changes wait before they are applied."""))
+conf.registerGroup(conf.supybot.plugins.NewKarma.rateLimit, 'nick')
+conf.registerChannelValue(conf.supybot.plugins.NewKarma.rateLimit.nick, 'rate',
+    registry.Float(60.0, """Determines how many karma changes one nick may
+    make per minute, on average.  0 disables this limit."""))
+conf.registerChannelValue(conf.supybot.plugins.NewKarma.rateLimit.nick, 'burst',
+    registry.PositiveInteger(20, """Determines how many karma changes one nick
+    may make in a quick burst before its rate limit applies."""))
+conf.registerGroup(conf.supybot.plugins.NewKarma.rateLimit, 'target')
+conf.registerChannelValue(conf.supybot.plugins.NewKarma.rateLimit.target, 'rate',
+    registry.Float(60.0, """Determines how many karma changes one thing may
+    receive per minute, on average.  0 disables this limit."""))
+conf.registerChannelValue(conf.supybot.plugins.NewKarma.rateLimit.target, 'burst',
+    registry.PositiveInteger(20, """Determines how many karma changes one
+    thing may receive in a quick burst before its rate limit applies."""))
+conf.registerGroup(conf.supybot.plugins.NewKarma.rateLimit, 'channel')
+conf.registerChannelValue(conf.supybot.plugins.NewKarma.rateLimit.channel, 'rate',
+    registry.Float(0.0, """Determines how many karma changes may be made in
+    the whole channel per minute, on average.  0 disables this limit."""))
+conf.registerChannelValue(conf.supybot.plugins.NewKarma.rateLimit.channel, 'burst',
+    registry.PositiveInteger(50, """Determines how many karma changes may be
+    made in the whole channel in a quick burst before its rate limit
+    applies."""))
 
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
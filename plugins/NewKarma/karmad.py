@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+karmad: a standalone storage daemon for NewKarma.
+
+Several bots (one per network, say) pointing at the same per-channel SQLite
+files fight over the file locks.  Instead, run one karmad that owns the
+databases and have every bot use the 'karmad' entry of supybot.databases.
+
+The daemon speaks one JSON object per line over a Unix socket:
+
+    {"id": 1, "op": "karma.increment", "args": ["#chan", "foo"]}
+    {"id": 1, "result": null}
+
+Clients may pipeline any number of requests; responses come back in order.
+All the writes read in one pass of the event loop are committed together
+before any of their responses are sent.
+
+Usage: karmad.py --socket /path/to/karmad.sock --directory /path/to/data
+"""
+
+import os
+import sys
+import errno
+import select
+import socket
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import supybot.conf as conf
+import supybot.log as log
+
+import plugin
+
+karmaOps = ('get', 'gets', 'top', 'bottom', 'rank', 'size', 'increment',
+            'decrement', 'garbageCollect', 'applyChanges', 'most', 'clear',
+            'stats', 'dump', 'load')
+aliasOps = ('get_aliases', 'get', 'alias', 'unalias', 'dump', 'load')
+
+class Client(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = ''
+        self.outbuf = ''
+        self.closing = False
+
+class Karmad(object):
+    def __init__(self, path):
+        self.path = path
+        self.karma = plugin.SqliteKarmaDB('Karma.sqlite3.db')
+        self.aliases = plugin.SqliteAliasDB('KarmaAliases.sqlite3.db')
+        self.karma.deferCommits = True
+        self.aliases.deferCommits = True
+        self.clients = {}
+        self.running = False
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(64)
+        self.server.setblocking(0)
+
+    def dispatch(self, line):
+        response = {'id': None}
+        try:
+            # The daemon is shared by every bot, so a bad line from one of
+            # them only gets an error back.
+            try:
+                request = plugin.fromWire(line)
+            except ValueError:
+                raise plugin.KarmadError, 'request is not JSON'
+            if not isinstance(request, dict):
+                raise plugin.KarmadError, 'request is not an object'
+            response['id'] = request.get('id')
+            (namespace, method) = request['op'].split('.', 1)
+            if namespace == 'karma' and method in karmaOps:
+                db = self.karma
+            elif namespace == 'alias' and method in aliasOps:
+                db = self.aliases
+            else:
+                raise plugin.KarmadError, 'unknown op %r' % request['op']
+            response['result'] = getattr(db, method)(*request['args'])
+        except Exception, e:
+            if not isinstance(e, (ValueError, plugin.KarmadError)):
+                log.exception('karmad: error handling %r:', line)
+            response['error'] = e.__class__.__name__
+            response['message'] = str(e)
+        return plugin.toWire(response)
+
+    def _accept(self):
+        while True:
+            try:
+                (sock, _) = self.server.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(0)
+            self.clients[sock] = Client(sock)
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            data = ''
+        if not data:
+            client.closing = True
+            return []
+        client.inbuf += data
+        lines = client.inbuf.split('\n')
+        client.inbuf = lines.pop()
+        return lines
+
+    def _write(self, client):
+        try:
+            sent = client.sock.send(client.outbuf)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            client.outbuf = ''
+            client.closing = True
+            return
+        client.outbuf = client.outbuf[sent:]
+
+    def _drop(self, client):
+        del self.clients[client.sock]
+        client.sock.close()
+
+    def serveOnce(self, timeout=None):
+        readers = [self.server] + self.clients.keys()
+        writers = [sock for (sock, client) in self.clients.iteritems()
+                   if client.outbuf]
+        try:
+            (readable, writable, _) = select.select(readers, writers, [],
+                                                    timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        pending = []
+        for sock in readable:
+            if sock is self.server:
+                self._accept()
+            else:
+                client = self.clients[sock]
+                pending.extend([(client, line) for line in self._read(client)
+                                if line.strip()])
+        for (client, line) in pending:
+            client.outbuf += self.dispatch(line) + '\n'
+        # Group commit: nothing is acknowledged before it is on disk.
+        self.karma.flush()
+        self.aliases.flush()
+        for client in self.clients.values():
+            if client.outbuf:
+                self._write(client)
+            if client.closing and not client.outbuf:
+                self._drop(client)
+
+    def serve(self):
+        self.running = True
+        try:
+            while self.running:
+                self.serveOnce()
+        finally:
+            self.close()
+
+    def close(self):
+        for client in self.clients.values():
+            self._drop(client)
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.karma.close()
+        self.aliases.close()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--socket', dest='socket', default='karmad.sock',
+                      help='Unix socket to listen on.')
+    parser.add_option('--directory', dest='directory', default='data',
+                      help='Data directory holding the per-channel '
+                           'databases; may be shared with a bot.')
+    (options, args) = parser.parse_args()
+    conf.supybot.directories.data.setValue(options.directory)
+    daemon = Karmad(options.socket)
+    import signal
+    def stop(signum, frame):
+        daemon.running = False
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    daemon.serve()
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -29,78 +29,363 @@
 ###
 
 import os
+import sys
 import csv
+import time
+import math
+import array
+import heapq
+import socket
+import threading
 
 import supybot.conf as conf
 import supybot.utils as utils
 from supybot.commands import *
 import supybot.plugins as plugins
+import supybot.schedule as schedule
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
 import supybot.log as log
+import supybot.world as world
 
 try:
     import sqlite3
 except ImportError:
     from pysqlite2 import dbapi2 as sqlite3 # for python2.4
 
-class SqliteKarmaDB(object):
+try:
+    import json
+except ImportError:
+    import simplejson as json # for python2.5
+
+# Database files this process has already opened and set up, so that opening
+# them again (for another channel's store, or after a reload) skips the
+# schema check.  The guard keeps reload(plugin) from forgetting them.
+try:
+    checkedDatabases
+except NameError:
+    checkedDatabases = set()
+
+class ReaderPool(object):
+    """Read-only connections to one database, shared by the threads running
+    read commands.  With the database in WAL mode, each reader sees the last
+    committed snapshot, and readers and the writer never wait on each
+    other."""
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        self.idle = []
+        self.opened = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        self.cond.acquire()
+        try:
+            while not self.idle and self.opened >= self.size:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.opened += 1
+        finally:
+            self.cond.release()
+        db = sqlite3.connect(self.filename, check_same_thread=False)
+        db.text_factory = str
+        db.cursor().execute("""PRAGMA query_only = ON""")
+        return db
+
+    def release(self, db):
+        self.cond.acquire()
+        try:
+            self.idle.append(db)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def close(self):
+        self.cond.acquire()
+        try:
+            for db in self.idle:
+                db.close()
+            self.opened -= len(self.idle)
+            self.idle = []
+        finally:
+            self.cond.release()
+
+    def detach(self):
+        """Gives up the idle connections, for a pool taking over on reload;
+        ones still in use are closed when they're collected."""
+        self.cond.acquire()
+        try:
+            (idle, self.idle) = (self.idle, [])
+            self.opened -= len(idle)
+            return idle
+        finally:
+            self.cond.release()
+
+    def attach(self, idle):
+        self.cond.acquire()
+        try:
+            for db in idle:
+                if self.opened < self.size:
+                    self.idle.append(db)
+                    self.opened += 1
+                else:
+                    db.close()
+        finally:
+            self.cond.release()
+
+class KarmaDistribution(object):
+    """Running statistics over the karma totals of one channel.  counts maps
+    each distinct total to how many things have it; together with the
+    running count, sum and sum of squares, every change is O(1), and
+    quantiles and histograms only walk the distinct totals, never the
+    things themselves."""
+    percentiles = (10, 25, 50, 75, 90, 99)
+    def __init__(self, totals=()):
+        self.counts = {}
+        self.n = 0
+        self.sum = 0
+        self.sumSquares = 0
+        for total in totals:
+            self.add(total)
+
+    def add(self, total):
+        self.counts[total] = self.counts.get(total, 0) + 1
+        self.n += 1
+        self.sum += total
+        self.sumSquares += total * total
+
+    def remove(self, total):
+        self.counts[total] -= 1
+        if not self.counts[total]:
+            del self.counts[total]
+        self.n -= 1
+        self.sum -= total
+        self.sumSquares -= total * total
+
+    def change(self, old, new):
+        """Records a thing's total going from old to new; None stands for a
+        thing that doesn't exist."""
+        if old is not None:
+            self.remove(old)
+        if new is not None:
+            self.add(new)
+
+    def mean(self):
+        return float(self.sum) / self.n
+
+    def stddev(self):
+        mean = self.mean()
+        return max(float(self.sumSquares) / self.n - mean * mean, 0) ** 0.5
+
+    def quantile(self, q):
+        """Returns the nearest-rank q-quantile, for 0 <= q <= 1."""
+        rank = max(int(math.ceil(q * self.n)), 1)
+        seen = 0
+        for total in sorted(self.counts):
+            seen += self.counts[total]
+            if seen >= rank:
+                return total
+
+    def histogram(self, buckets=10):
+        """Returns (low, high, count) for up to buckets equal-width ranges of
+        totals, from the lowest total to the highest."""
+        low = min(self.counts)
+        width = int(math.ceil((max(self.counts) - low + 1) / float(buckets)))
+        L = []
+        for i in range(buckets):
+            start = low + i * width
+            if start > max(self.counts):
+                break
+            L.append([start, start + width - 1, 0])
+        for (total, count) in self.counts.iteritems():
+            L[(total - low) // width][2] += count
+        return map(tuple, L)
+
+    def summary(self):
+        if not self.n:
+            return {'count': 0}
+        return {'count': self.n,
+                'mean': self.mean(),
+                'stddev': self.stddev(),
+                'min': min(self.counts),
+                'max': max(self.counts),
+                'median': self.quantile(0.5),
+                'percentiles': [(p, self.quantile(p / 100.0))
+                                for p in self.percentiles],
+                'histogram': self.histogram()}
+
+def synchronizedOn(name):
+    """Returns a decorator making a method hold its object's lock called
+    name while it runs."""
+    def decorator(f):
+        def g(self, *args):
+            lock = getattr(self, name)
+            lock.acquire()
+            try:
+                return f(self, *args)
+            finally:
+                lock.release()
+        g.__name__ = f.__name__
+        g.__doc__ = f.__doc__
+        return g
+    return decorator
+
+synchronized = synchronizedOn('lock')
+
+class SqliteDB(object):
+    """What the sqlite3 stores have in common: a writer connection to each
+    channel's database, a pool of read-only connections beside it, and
+    commits that can be deferred.  schema is the statement creating the
+    table of a new database."""
+    readerPoolSize = 2
+    schema = None
     def __init__(self, filename):
         self.dbs = ircutils.IrcDict()
         self.filename = filename
+        # When deferCommits is set, writes are left in an open transaction
+        # until flush() is called, so callers can group many of them into a
+        # single commit.
+        self.deferCommits = False
+        self.dirty = {}
+        self.readers = ircutils.IrcDict()
+        self.lock = threading.Lock()
 
     def close(self):
+        self.flush()
+        for pool in self.readers.itervalues():
+            pool.close()
         for db in self.dbs.itervalues():
             db.close()
 
+    def _commit(self, db):
+        if self.deferCommits:
+            self.dirty[id(db)] = db
+        else:
+            db.commit()
+
+    def flush(self):
+        for db in self.dirty.values():
+            db.commit()
+        self.dirty.clear()
+
+    def detach(self):
+        """Commits anything pending and gives up the open connections, to be
+        handed to the store replacing this one when the plugin is reloaded;
+        see attach.  Only the sqlite3 connections themselves are handed over,
+        so that nothing built by the old module's classes survives it."""
+        self.flush()
+        readers = {}
+        for (filename, pool) in self.readers.items():
+            readers[filename] = pool.detach()
+        dbs = dict(self.dbs.items())
+        self.dbs.clear()
+        self.readers.clear()
+        return {'dbs': dbs, 'readers': readers}
+
+    def attach(self, detached):
+        """Takes over the connections another store's detach returned.
+        Whatever that store cached is built again as it's needed."""
+        self.dbs.update(detached['dbs'])
+        for (filename, idle) in detached['readers'].iteritems():
+            pool = ReaderPool(filename, self.readerPoolSize)
+            pool.attach(idle)
+            self.readers[filename] = pool
+
     def _getDb(self, channel):
         filename = plugins.makeChannelFilename(self.filename, channel)
         if filename in self.dbs:
             return self.dbs[filename]
-        if os.path.exists(filename):
-            db = sqlite3.connect(filename)
-            db.text_factory = str
-            self.dbs[filename] = db
-            return db
-        db = sqlite3.connect(filename)
+        self.lock.acquire()
+        try:
+            if filename not in self.dbs:
+                self.dbs[filename] = self._openDb(filename)
+        finally:
+            self.lock.release()
+        return self.dbs[filename]
+
+    def _openDb(self, filename):
+        # The writer is only ever used by one thread at a time, but it may be
+        # opened from whichever thread first touches the channel.
+        exists = os.path.exists(filename)
+        db = sqlite3.connect(filename, check_same_thread=False)
         db.text_factory = str
-        self.dbs[filename] = db
+        if exists and filename in checkedDatabases:
+            return db
         cursor = db.cursor()
-        cursor.execute("""CREATE TABLE karma (
-                          id INTEGER PRIMARY KEY,
-                          name TEXT,
-                          normalized TEXT UNIQUE ON CONFLICT IGNORE,
-                          added INTEGER,
-                          subtracted INTEGER
-                          )""")
+        cursor.execute("""PRAGMA journal_mode=WAL""")
+        checkedDatabases.add(filename)
+        if exists:
+            return db
+        cursor.execute(self.schema)
         db.commit()
         def p(s1, s2):
             return int(ircutils.nickEqual(s1, s2))
         db.create_function('nickeq', 2, p)
         return db
 
-    def get(self, channel, thing):
+    def _query(self, channel, sql, args=()):
         db = self._getDb(channel)
+        # Uncommitted writes are only visible to the writer.  The main thread,
+        # which does the writing, reads through it too: waiting for a pooled
+        # connection would hold it up behind whatever the threaded read
+        # commands are running.
+        if id(db) in self.dirty or world.isMainThread():
+            cursor = db.cursor()
+            cursor.execute(sql, args)
+            return cursor.fetchall()
+        filename = plugins.makeChannelFilename(self.filename, channel)
+        self.lock.acquire()
+        try:
+            if filename not in self.readers:
+                self.readers[filename] = ReaderPool(filename,
+                                                    self.readerPoolSize)
+            pool = self.readers[filename]
+        finally:
+            self.lock.release()
+        reader = pool.acquire()
+        try:
+            cursor = reader.cursor()
+            cursor.execute(sql, args)
+            return cursor.fetchall()
+        finally:
+            pool.release(reader)
+
+class SqliteKarmaDB(SqliteDB):
+    readerPoolSize = 4
+    schema = """CREATE TABLE karma (
+                id INTEGER PRIMARY KEY,
+                name TEXT,
+                normalized TEXT UNIQUE ON CONFLICT IGNORE,
+                added INTEGER,
+                subtracted INTEGER
+                )"""
+    def __init__(self, filename):
+        SqliteDB.__init__(self, filename)
+        # Distributions are only built the first time stats are asked for;
+        # after that every write keeps them up to date.  stats runs in a
+        # thread of its own, so building one and every write that might
+        # change one hold distributionLock.
+        self.distributions = ircutils.IrcDict()
+        self.distributionLock = threading.RLock()
+
+    def get(self, channel, thing):
         thing = thing.lower()
-        cursor = db.cursor()
-        cursor.execute("""SELECT added, subtracted FROM karma
-                          WHERE normalized=?""", (thing,))
-        results = cursor.fetchall()
+        results = self._query(channel, """SELECT added, subtracted FROM karma
+                                          WHERE normalized=?""", (thing,))
         if len(results) == 0:
             return None
         else:
             return map(int, results[0])
 
     def gets(self, channel, things):
-        db = self._getDb(channel)
-        cursor = db.cursor()
         normalizedThings = dict(zip(map(lambda s: s.lower(), things), things))
         criteria = ' OR '.join(['normalized=?'] * len(normalizedThings))
         sql = """SELECT name, added-subtracted FROM karma
                  WHERE %s ORDER BY added-subtracted DESC""" % criteria
-        cursor.execute(sql, normalizedThings.keys())
-        L = [(name, int(karma)) for (name, karma) in cursor.fetchall()]
+        L = [(name, int(karma)) for (name, karma)
+             in self._query(channel, sql, normalizedThings.keys())]
         for (name, _) in L:
             del normalizedThings[name.lower()]
         neutrals = normalizedThings.values()
@@ -108,65 +393,151 @@ class SqliteKarmaDB(object):
         return (L, neutrals)
 
     def top(self, channel, limit):
-        db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT name, added-subtracted FROM karma
-                          ORDER BY added-subtracted DESC LIMIT ?""", (limit,))
-        return [(t[0], int(t[1])) for t in cursor.fetchall()]
+        results = self._query(channel, """SELECT name, added-subtracted
+                                          FROM karma ORDER BY
+                                          added-subtracted DESC LIMIT ?""",
+                              (limit,))
+        return [(t[0], int(t[1])) for t in results]
 
     def bottom(self, channel, limit):
-        db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT name, added-subtracted FROM karma
-                          ORDER BY added-subtracted ASC LIMIT ?""", (limit,))
-        return [(t[0], int(t[1])) for t in cursor.fetchall()]
+        results = self._query(channel, """SELECT name, added-subtracted
+                                          FROM karma ORDER BY
+                                          added-subtracted ASC LIMIT ?""",
+                              (limit,))
+        return [(t[0], int(t[1])) for t in results]
 
     def rank(self, channel, thing):
-        db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT added-subtracted FROM karma
-                          WHERE name=?""", (thing,))
-        results = cursor.fetchall()
+        results = self._query(channel, """SELECT added-subtracted FROM karma
+                                          WHERE name=?""", (thing,))
         if len(results) == 0:
             return None
         karma = int(results[0][0])
-        cursor.execute("""SELECT COUNT(*) FROM karma
-                          WHERE added-subtracted > ?""", (karma,))
-        rank = int(cursor.fetchone()[0])
+        results = self._query(channel, """SELECT COUNT(*) FROM karma
+                                          WHERE added-subtracted > ?""",
+                              (karma,))
+        rank = int(results[0][0])
         return rank+1
 
     def size(self, channel):
-        db = self._getDb(channel)
+        results = self._query(channel, """SELECT COUNT(*) FROM karma""")
+        return int(results[0][0])
+
+    @synchronizedOn('distributionLock')
+    def _getDistribution(self, channel):
+        filename = plugins.makeChannelFilename(self.filename, channel)
+        if filename not in self.distributions:
+            results = self._query(channel, """SELECT added-subtracted
+                                              FROM karma""")
+            totals = [int(t[0]) for t in results]
+            self.distributions[filename] = KarmaDistribution(totals)
+        return self.distributions[filename]
+
+    def _trackedTotal(self, channel, db, normalized):
+        """Returns the distribution for channel and the current total of
+        normalized, if the distribution is being kept; otherwise (None,
+        None)."""
+        filename = plugins.makeChannelFilename(self.filename, channel)
+        distribution = self.distributions.get(filename)
+        if distribution is None:
+            return (None, None)
         cursor = db.cursor()
-        cursor.execute("""SELECT COUNT(*) FROM karma""")
-        return int(cursor.fetchone()[0])
+        cursor.execute("""SELECT added-subtracted FROM karma
+                          WHERE normalized=?""", (normalized,))
+        results = cursor.fetchall()
+        if len(results) == 0:
+            return (distribution, None)
+        else:
+            return (distribution, int(results[0][0]))
 
+    @synchronizedOn('distributionLock')
+    def stats(self, channel):
+        return self._getDistribution(channel).summary()
+
+    @synchronizedOn('distributionLock')
     def increment(self, channel, name):
         db = self._getDb(channel)
         cursor = db.cursor()
         normalized = name.lower()
+        (distribution, old) = self._trackedTotal(channel, db, normalized)
         cursor.execute("""INSERT INTO karma VALUES (NULL, ?, ?, 0, 0)""",
                        (name, normalized,))
         cursor.execute("""UPDATE karma SET added=added+1
                           WHERE normalized=?""", (normalized,))
-        db.commit()
+        self._commit(db)
+        if distribution is not None:
+            distribution.change(old, (old or 0) + 1)
 
+    @synchronizedOn('distributionLock')
     def decrement(self, channel, name):
         db = self._getDb(channel)
         cursor = db.cursor()
         normalized = name.lower()
+        (distribution, old) = self._trackedTotal(channel, db, normalized)
         cursor.execute("""INSERT INTO karma VALUES (NULL, ?, ?, 0, 0)""",
                        (name, normalized,))
         cursor.execute("""UPDATE karma SET subtracted=subtracted+1
                           WHERE normalized=?""", (normalized,))
-        db.commit()
+        self._commit(db)
+        if distribution is not None:
+            distribution.change(old, (old or 0) - 1)
 
+    @synchronizedOn('distributionLock')
+    def applyChanges(self, channel, changes):
+        """Applies changes, a list of (name, delta), in order and in a single
+        transaction.  A positive delta is added to name's increases and a
+        negative one to its decreases; a thing whose karma comes back to zero
+        is forgotten, as by garbageCollect.  Returns [added, subtracted] for
+        each change, as it stood right after it."""
+        db = self._getDb(channel)
+        cursor = db.cursor()
+        filename = plugins.makeChannelFilename(self.filename, channel)
+        distribution = self.distributions.get(filename)
+        results = []
+        for (name, delta) in changes:
+            normalized = name.lower()
+            cursor.execute("""SELECT added, subtracted FROM karma
+                              WHERE normalized=?""", (normalized,))
+            row = cursor.fetchone()
+            if row is None:
+                (added, subtracted) = (0, 0)
+                old = None
+            else:
+                (added, subtracted) = map(int, row)
+                old = added - subtracted
+            if delta > 0:
+                added += delta
+            else:
+                subtracted -= delta
+            if added == subtracted:
+                new = None
+                cursor.execute("""DELETE FROM karma WHERE normalized=?""",
+                               (normalized,))
+            else:
+                new = added - subtracted
+                if row is None:
+                    cursor.execute("""INSERT INTO karma
+                                      VALUES (NULL, ?, ?, ?, ?)""",
+                                   (name, normalized, added, subtracted))
+                else:
+                    cursor.execute("""UPDATE karma SET added=?, subtracted=?
+                                      WHERE normalized=?""",
+                                   (added, subtracted, normalized))
+            if distribution is not None and (old, new) != (None, None):
+                distribution.change(old, new)
+            results.append([added, subtracted])
+        self._commit(db)
+        return results
+
+    @synchronizedOn('distributionLock')
     def garbageCollect(self, channel, name):
         db = self._getDb(channel)
         cursor = db.cursor()
         normalized = name.lower()
+        (distribution, old) = self._trackedTotal(channel, db, normalized)
         cursor.execute("""DELETE FROM karma WHERE normalized='%s'""" % (normalized))
-        db.commit()
+        self._commit(db)
+        if distribution is not None:
+            distribution.change(old, None)
 
     def most(self, channel, kind, limit):
         if kind == 'increased':
@@ -179,165 +550,1138 @@ class SqliteKarmaDB(object):
             raise ValueError, 'invalid kind'
         sql = """SELECT name, %s FROM karma ORDER BY %s DESC LIMIT %s""" % \
               (orderby, orderby, limit)
-        db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute(sql)
-        return [(name, int(i)) for (name, i) in cursor.fetchall()]
+        return [(name, int(i)) for (name, i) in self._query(channel, sql)]
 
+    @synchronizedOn('distributionLock')
     def clear(self, channel, name):
         db = self._getDb(channel)
         cursor = db.cursor()
         normalized = name.lower()
+        (distribution, old) = self._trackedTotal(channel, db, normalized)
         cursor.execute("""UPDATE karma SET subtracted=0, added=0
                           WHERE normalized=?""", (normalized,))
-        db.commit()
+        self._commit(db)
+        if distribution is not None and old is not None:
+            distribution.change(old, 0)
 
     def dump(self, channel, filename):
         filename = conf.supybot.directories.data.dirize(filename)
         fd = utils.transactionalFile(filename)
         out = csv.writer(fd)
-        db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT name, added, subtracted FROM karma""")
-        for (name, added, subtracted) in cursor.fetchall():
+        results = self._query(channel, """SELECT name, added, subtracted
+                                          FROM karma""")
+        for (name, added, subtracted) in results:
             out.writerow([name, added, subtracted])
         fd.close()
 
     def load(self, channel, filename):
         filename = conf.supybot.directories.data.dirize(filename)
         fd = file(filename)
-        reader = csv.reader(fd)
+        try:
+            self.loadRows(channel, csv.reader(fd))
+        finally:
+            fd.close()
+
+    @synchronizedOn('distributionLock')
+    def loadRows(self, channel, rows):
+        """Replaces the karma of channel with rows of (name, added,
+        subtracted), in a single transaction."""
         db = self._getDb(channel)
         cursor = db.cursor()
         cursor.execute("""DELETE FROM karma""")
-        for (name, added, subtracted) in reader:
-            normalized = name.lower()
-            cursor.execute("""INSERT INTO karma
-                              VALUES (NULL, ?, ?, ?, ?)""",
-                           (name, normalized, added, subtracted,))
-        db.commit()
+        cursor.executemany("""INSERT INTO karma VALUES (NULL, ?, ?, ?, ?)""",
+                           ((name, name.lower(), added, subtracted)
+                            for (name, added, subtracted) in rows))
+        self._commit(db)
+        filename = plugins.makeChannelFilename(self.filename, channel)
+        if filename in self.distributions:
+            del self.distributions[filename]
+
+class KarmaTable(object):
+    """The karma of one channel's things, laid out to stay small with
+    millions of them.  Each thing has a slot: its name is in names and its
+    counts in the added and subtracted arrays, and index maps its normalized
+    name to the slot.  A name that is already lowercase is the same string
+    as its key.  The slots of forgotten things are reused."""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.index = {}
+        self.names = []
+        self.added = array.array('l')
+        self.subtracted = array.array('l')
+        self.free = []
+
+    def __len__(self):
+        return len(self.index)
+
+    def find(self, name):
+        """Returns the slot of name, or None if it has no karma."""
+        return self.index.get(name.lower())
+
+    def set(self, name, added=0, subtracted=0):
+        """Gives name the given counts, adding it if it's new, and returns
+        its slot."""
+        normalized = name.lower()
+        if normalized == name:
+            name = normalized
+        slot = self.index.get(normalized)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = len(self.names)
+                self.names.append(None)
+                self.added.append(0)
+                self.subtracted.append(0)
+            self.index[normalized] = slot
+        self.names[slot] = name
+        self.added[slot] = added
+        self.subtracted[slot] = subtracted
+        return slot
+
+    def remove(self, slot):
+        del self.index[self.names[slot].lower()]
+        self.names[slot] = None
+        self.free.append(slot)
+
+    def total(self, slot):
+        return self.added[slot] - self.subtracted[slot]
+
+    def slots(self):
+        return self.index.itervalues()
+
+    def rows(self):
+        """Yields (name, added, subtracted) for every thing."""
+        for slot in self.index.itervalues():
+            yield (self.names[slot], self.added[slot], self.subtracted[slot])
+
+class KarmaJournal(object):
+    """The karma of one channel, held in memory.  Every change is appended
+    to a journal next to the snapshot file, and the journal is folded into
+    a new snapshot once it grows past compactEvery entries.
+
+    Both files start with a generation row; a journal only applies on top of
+    the snapshot of the same generation, so a crash between writing a new
+    snapshot and truncating the journal cannot apply the journal twice.
+    """
+    compactEvery = 10000
+    def __init__(self, filename):
+        self.filename = filename
+        self.journalFilename = filename + '.journal'
+        self.records = KarmaTable()
+        self.distribution = None
+        self.generation = 0
+        self.entries = 0
+        self.journal = None
+        self._replay()
+
+    def _completeLines(self, fd):
+        # A torn final line from a crash mid-append is ignored.
+        for line in fd:
+            if line.endswith('\n'):
+                yield line
+
+    def _readRows(self, filename):
+        # A torn final line is also cut off, so that the next append starts
+        # a line of its own rather than finishing it.
+        if not os.path.exists(filename):
+            return []
+        fd = file(filename, 'r+b')
+        try:
+            lines = list(self._completeLines(fd))
+            complete = sum(map(len, lines))
+            fd.seek(0, 2)
+            if fd.tell() > complete:
+                fd.truncate(complete)
+            return list(csv.reader(lines))
+        finally:
+            fd.close()
+
+    def _malformed(self, filename, row):
+        log.warning('NewKarma: Ignoring malformed row %r in %s.',
+                    row, filename)
+
+    def _replay(self):
+        # The snapshot is read a row at a time rather than into a list, which
+        # for a big channel would take several times the memory of the
+        # records themselves.
+        if os.path.exists(self.filename):
+            fd = file(self.filename, 'rb')
+            try:
+                rows = csv.reader(self._completeLines(fd))
+                for (i, row) in enumerate(rows):
+                    if i == 0 and row[0] == 'generation':
+                        self.generation = int(row[1])
+                        continue
+                    try:
+                        (name, added, subtracted) = row
+                        self.records.set(name, int(added), int(subtracted))
+                    except ValueError:
+                        self._malformed(self.filename, row)
+            finally:
+                fd.close()
+        rows = self._readRows(self.journalFilename)
+        if rows and rows[0] == ['generation', str(self.generation)]:
+            for row in rows[1:]:
+                if len(row) != 2 or row[0] not in ('+', '-', 'c', 'g'):
+                    self._malformed(self.journalFilename, row)
+                    continue
+                self.apply(*row)
+                self.entries += 1
+            self.journal = file(self.journalFilename, 'ab')
+        else:
+            self._startJournal()
+
+    def _startJournal(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = file(self.journalFilename, 'wb')
+        csv.writer(self.journal).writerow(['generation', self.generation])
+        self.journal.flush()
+        self.entries = 0
+
+    def getDistribution(self):
+        if self.distribution is None:
+            totals = [self.records.total(slot)
+                      for slot in self.records.slots()]
+            self.distribution = KarmaDistribution(totals)
+        return self.distribution
+
+    def apply(self, op, name):
+        records = self.records
+        slot = records.find(name)
+        if slot is None:
+            old = None
+        else:
+            old = records.total(slot)
+        if op in '+-':
+            if slot is None:
+                slot = records.set(name)
+            if op == '+':
+                records.added[slot] += 1
+            else:
+                records.subtracted[slot] += 1
+        elif slot is not None:
+            if op == 'c':
+                records.added[slot] = 0
+                records.subtracted[slot] = 0
+            elif op == 'g':
+                records.remove(slot)
+                slot = None
+        if self.distribution is not None and (old, slot) != (None, None):
+            if slot is None:
+                self.distribution.change(old, None)
+            else:
+                self.distribution.change(old, records.total(slot))
+
+    def log(self, op, name):
+        self.apply(op, name)
+        self.write([(op, name)])
+
+    def write(self, entries):
+        """Appends entries of (op, name), already applied, to the journal
+        with a single flush."""
+        csv.writer(self.journal).writerows(entries)
+        self.journal.flush()
+        self.entries += len(entries)
+        if self.entries >= self.compactEvery:
+            self.compact()
+
+    def compact(self):
+        fd = utils.transactionalFile(self.filename, makeBackupIfSmaller=False)
+        out = csv.writer(fd)
+        out.writerow(['generation', self.generation + 1])
+        out.writerows(self.records.rows())
         fd.close()
+        self.generation += 1
+        self._startJournal()
+
+    def close(self):
+        if self.entries:
+            self.compact()
+        self.journal.close()
+
+class JournalKarmaDB(object):
+    """Karma kept in memory and persisted as an append-only journal per
+    channel; see KarmaJournal.  Suited to busy channels, where updating a
+    B-tree for every karma change costs more than it is worth.
 
-class SqliteAliasDB(object):
+    Read commands run in threads of their own, so everything that touches
+    the journals holds lock: there are no snapshots to read from, and the
+    records can't be walked while the main thread changes them."""
     def __init__(self, filename):
         self.dbs = ircutils.IrcDict()
         self.filename = filename
+        self.lock = threading.RLock()
 
+    @synchronized
     def close(self):
         for db in self.dbs.itervalues():
             db.close()
+        self.dbs.clear()
 
+    def flush(self):
+        pass
+
+    def detach(self):
+        # There are no connections to hand over: the journals are closed, and
+        # the new store replays them as each channel is used.
+        self.close()
+        return {}
+
+    def attach(self, detached):
+        pass
+
+    @synchronized
     def _getDb(self, channel):
         filename = plugins.makeChannelFilename(self.filename, channel)
-        if filename in self.dbs:
-            return self.dbs[filename]
-        if os.path.exists(filename):
-            db = sqlite3.connect(filename)
-            db.text_factory = str
-            self.dbs[filename] = db
-            return db
-        db = sqlite3.connect(filename)
-        db.text_factory = str
-        self.dbs[filename] = db
-        cursor = db.cursor()
-        cursor.execute("""CREATE TABLE alias (
-                          id INTEGER PRIMARY KEY,
-                          name TEXT,
-                          normalized TEXT,
-                          aliases TEXT
-                          )""")
-        db.commit()
-        def p(s1, s2):
-            return int(ircutils.nickEqual(s1, s2))
-        db.create_function('nickeq', 2, p)
-        return db
+        if filename not in self.dbs:
+            self.dbs[filename] = KarmaJournal(filename)
+        return self.dbs[filename]
 
-    def get_aliases(self, channel, thing):
+    @synchronized
+    def get(self, channel, thing):
+        records = self._getDb(channel).records
+        slot = records.find(thing)
+        if slot is None:
+            return None
+        else:
+            return [records.added[slot], records.subtracted[slot]]
+
+    @synchronized
+    def gets(self, channel, things):
+        records = self._getDb(channel).records
+        normalizedThings = dict(zip(map(lambda s: s.lower(), things), things))
+        L = [records.index[normalized] for normalized in normalizedThings
+             if normalized in records.index]
+        L.sort(key=records.total, reverse=True)
+        for slot in L:
+            del normalizedThings[records.names[slot].lower()]
+        neutrals = normalizedThings.values()
+        neutrals.sort()
+        return ([(records.names[slot], records.total(slot)) for slot in L],
+                neutrals)
+
+    @synchronized
+    def top(self, channel, limit):
+        records = self._getDb(channel).records
+        L = heapq.nlargest(limit, records.slots(), key=records.total)
+        return [(records.names[slot], records.total(slot)) for slot in L]
+
+    @synchronized
+    def bottom(self, channel, limit):
+        records = self._getDb(channel).records
+        L = heapq.nsmallest(limit, records.slots(), key=records.total)
+        return [(records.names[slot], records.total(slot)) for slot in L]
+
+    @synchronized
+    def rank(self, channel, thing):
+        records = self._getDb(channel).records
+        slot = records.find(thing)
+        if slot is None:
+            return None
+        karma = records.total(slot)
+        rank = len([other for other in records.slots()
+                    if records.total(other) > karma])
+        return rank+1
+
+    @synchronized
+    def size(self, channel):
+        return len(self._getDb(channel).records)
+
+    @synchronized
+    def increment(self, channel, name):
+        self._getDb(channel).log('+', name)
+
+    @synchronized
+    def decrement(self, channel, name):
+        self._getDb(channel).log('-', name)
+
+    @synchronized
+    def garbageCollect(self, channel, name):
+        self._getDb(channel).log('g', name)
+
+    @synchronized
+    def applyChanges(self, channel, changes):
         db = self._getDb(channel)
-        thing = thing.lower()
-        cursor = db.cursor()
-        cursor.execute("""SELECT aliases FROM alias
-                          WHERE normalized=?""", (thing.lower(),))
-        results = cursor.fetchall()
-        if len(results) == 0:
-            return []
+        entries = []
+        results = []
+        for (name, delta) in changes:
+            if delta > 0:
+                op = '+'
+            else:
+                op = '-'
+            for _ in xrange(abs(delta)):
+                db.apply(op, name)
+                entries.append((op, name))
+            slot = db.records.find(name)
+            (added, subtracted) = (db.records.added[slot],
+                                   db.records.subtracted[slot])
+            results.append([added, subtracted])
+            if added == subtracted:
+                db.apply('g', name)
+                entries.append(('g', name))
+        db.write(entries)
+        return results
+
+    @synchronized
+    def most(self, channel, kind, limit):
+        records = self._getDb(channel).records
+        if kind == 'increased':
+            key = records.added.__getitem__
+        elif kind == 'decreased':
+            key = records.subtracted.__getitem__
+        elif kind == 'active':
+            key = lambda slot: records.added[slot] + records.subtracted[slot]
         else:
-            return [str(x[0]) for x in results]
+            raise ValueError, 'invalid kind'
+        return [(records.names[slot], key(slot))
+                for slot in heapq.nlargest(limit, records.slots(), key=key)]
 
-    def get(self, channel, thing):
+    @synchronized
+    def clear(self, channel, name):
+        self._getDb(channel).log('c', name)
+
+    @synchronized
+    def stats(self, channel):
+        return self._getDb(channel).getDistribution().summary()
+
+    @synchronized
+    def dump(self, channel, filename):
+        filename = conf.supybot.directories.data.dirize(filename)
+        fd = utils.transactionalFile(filename)
+        csv.writer(fd).writerows(self._getDb(channel).records.rows())
+        fd.close()
+
+    @synchronized
+    def load(self, channel, filename):
+        filename = conf.supybot.directories.data.dirize(filename)
+        fd = file(filename)
+        try:
+            self.loadRows(channel, csv.reader(fd))
+        finally:
+            fd.close()
+
+    @synchronized
+    def loadRows(self, channel, rows):
         db = self._getDb(channel)
+        db.records.clear()
+        db.distribution = None
+        for (name, added, subtracted) in rows:
+            db.records.set(name, int(added), int(subtracted))
+        db.compact()
+
+class AliasClosure(object):
+    """The alias graph of one channel, with every alias resolved ahead of
+    time to the full set of things it stands for, however long the chain.
+    edges maps each alias to the names it was given for, and parents is the
+    reverse; everything is lowercased.
+
+    An alias resolves to the things at the end of its chains.  Aliases
+    which only lead back to one another (a cycle) end at the members of the
+    cycle, other than the alias itself.
+    """
+    def __init__(self, pairs=()):
+        self.edges = {}
+        self.parents = {}
+        self.closure = {}
+        for (name, alias) in pairs:
+            self._link(alias.lower(), name.lower())
+        self._rebuild(self.edges.keys())
+
+    def _link(self, alias, name):
+        self.edges.setdefault(alias, set()).add(name)
+        self.parents.setdefault(name, set()).add(alias)
+
+    def resolve(self, alias):
+        return self.closure.get(alias.lower(), ())
+
+    def setTargets(self, alias, names):
+        """Makes alias stand for exactly names, and updates the closure of
+        every alias leading to it.  Returns any cycles found."""
+        alias = alias.lower()
+        for name in self.edges.pop(alias, ()):
+            self.parents[name].discard(alias)
+            if not self.parents[name]:
+                del self.parents[name]
+        for name in names:
+            self._link(alias, name.lower())
+        return self._rebuild(self._ancestors(alias))
+
+    def _ancestors(self, node):
+        seen = set([node])
+        stack = [node]
+        while stack:
+            for parent in self.parents.get(stack.pop(), ()):
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+        return seen
+
+    def _rebuild(self, nodes):
+        # Tarjan's algorithm, iteratively so that long chains can't hit the
+        # recursion limit.  Components come out sinks first, so the ends of
+        # everything a component leads to are known by the time it's done.
+        ends = {}
+        index = {}
+        low = {}
+        stack = []
+        onStack = set()
+        cycles = []
+        for root in nodes:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            onStack.add(root)
+            work = [(root, iter(self.edges.get(root, ())))]
+            while work:
+                (node, children) = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = len(index)
+                        stack.append(child)
+                        onStack.add(child)
+                        work.append((child, iter(self.edges.get(child, ()))))
+                        break
+                    elif child in onStack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        members = set()
+                        while node not in members:
+                            member = stack.pop()
+                            onStack.discard(member)
+                            members.add(member)
+                        if self._finish(members, ends):
+                            cycles.append(sorted(members))
+        return cycles
+
+    def _finish(self, members, ends):
+        exits = set()
+        cyclic = len(members) > 1
+        for member in members:
+            for child in self.edges.get(member, ()):
+                if child in members:
+                    cyclic = True
+                else:
+                    exits.add(child)
+        if exits:
+            reached = set()
+            for child in exits:
+                reached.update(ends[child])
+        else:
+            reached = members
+        for member in members:
+            ends[member] = reached
+            targets = reached - set([member])
+            if member in self.edges and targets:
+                self.closure[member] = tuple(sorted(targets))
+            else:
+                self.closure.pop(member, None)
+        return cyclic
+
+class SqliteAliasDB(SqliteDB):
+    schema = """CREATE TABLE alias (
+                id INTEGER PRIMARY KEY,
+                name TEXT,
+                normalized TEXT,
+                aliases TEXT
+                )"""
+    def __init__(self, filename):
+        SqliteDB.__init__(self, filename)
+        self.closures = ircutils.IrcDict()
+
+    def get_aliases(self, channel, thing):
         thing = thing.lower()
-        cursor = db.cursor()
-        cursor.execute("""SELECT normalized FROM alias
-                          WHERE aliases like ?""", (thing.lower(),))
-        results = cursor.fetchall()
+        results = self._query(channel, """SELECT aliases FROM alias
+                                          WHERE normalized=?""", (thing,))
         if len(results) == 0:
             return []
         else:
             return [str(x[0]) for x in results]
 
+    def _getClosure(self, channel):
+        filename = plugins.makeChannelFilename(self.filename, channel)
+        if filename not in self.closures:
+            self.closures[filename] = AliasClosure(self.pairs(channel))
+        return self.closures[filename]
+
+    def _refresh(self, channel, alias):
+        closure = self._getClosure(channel)
+        # Matched exactly, as AliasClosure does when it's built from
+        # pairs(); LIKE would also match aliases with _ or % in them.
+        results = self._query(channel, """SELECT normalized FROM alias
+                                          WHERE lower(aliases)=?""",
+                              (alias.lower(),))
+        for cycle in closure.setTargets(alias, [x[0] for x in results]):
+            log.warning('NewKarma: %s are aliases of one another in %s.',
+                        ', '.join(cycle), channel)
+
+    def get(self, channel, thing):
+        return list(self._getClosure(channel).resolve(thing))
+
     def alias(self, channel, name, alias):
         db = self._getDb(channel)
         cursor = db.cursor()
         cursor.execute("""INSERT INTO alias VALUES (NULL, ?, ?, ?)""", (name, name.lower(), alias,))
-        db.commit()
+        self._commit(db)
+        self._refresh(channel, alias)
 
     def unalias(self, channel, name, alias):
         db = self._getDb(channel)
         cursor = db.cursor()
         cursor.execute("""DELETE FROM alias where normalized=? AND aliases=?""", (name.lower(), alias,))
-        db.commit()
+        self._commit(db)
+        self._refresh(channel, alias)
+
+    def pairs(self, channel):
+        """Returns every (name, alias) in channel."""
+        return self._query(channel, """SELECT name, aliases FROM alias""")
 
     def dump(self, channel, filename):
         filename = conf.supybot.directories.data.dirize(filename)
         fd = utils.transactionalFile(filename)
         out = csv.writer(fd)
-        db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT name, aliases FROM alias""")
-        for (name, aliases) in cursor.fetchall():
+        for (name, aliases) in self.pairs(channel):
             out.writerow([name, aliases])
         fd.close()
 
     def load(self, channel, filename):
         filename = conf.supybot.directories.data.dirize(filename)
         fd = file(filename)
-        reader = csv.reader(fd)
+        try:
+            self.loadRows(channel, csv.reader(fd))
+        finally:
+            fd.close()
+
+    def loadRows(self, channel, rows):
+        """Replaces the aliases of channel with rows of (name, alias), in a
+        single transaction."""
         db = self._getDb(channel)
         cursor = db.cursor()
         cursor.execute("""DELETE FROM alias""")
-        for (name, aliases) in reader:
-            normalized = name.lower()
-            cursor.execute("""INSERT INTO alias
-                              VALUES (NULL, ?, ?, ?)""",
-                           (name, normalized, aliases,))
-        db.commit()
-        fd.close()
+        cursor.executemany("""INSERT INTO alias VALUES (NULL, ?, ?, ?)""",
+                           ((name, name.lower(), aliases)
+                            for (name, aliases) in rows))
+        self._commit(db)
+        filename = plugins.makeChannelFilename(self.filename, channel)
+        if filename in self.closures:
+            del self.closures[filename]
+
+class KarmadError(Exception):
+    pass
+
+def toWire(obj):
+    # Strings cross the socket as latin-1 so that arbitrary bytes from IRC
+    # survive the round trip through JSON unchanged.
+    return json.dumps(obj, encoding='latin-1')
+
+def fromWire(line):
+    def decode(obj):
+        if isinstance(obj, unicode):
+            return obj.encode('latin-1')
+        elif isinstance(obj, list):
+            return map(decode, obj)
+        elif isinstance(obj, dict):
+            return dict([(decode(k), decode(v)) for (k, v) in obj.iteritems()])
+        else:
+            return obj
+    return decode(json.loads(line))
+
+class KarmadClient(object):
+    """A connection to a karmad daemon.  Requests may be pipelined: callMany
+    sends all of its requests before reading any of the responses."""
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.buffer = ''
+        self.nextId = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.sock = sock
+        self.buffer = ''
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def detach(self):
+        """Gives up the socket, for the client replacing this one when the
+        plugin is reloaded."""
+        self.lock.acquire()
+        try:
+            (sock, self.sock) = (self.sock, None)
+            return sock
+        finally:
+            self.lock.release()
+
+    def attach(self, path, sock):
+        if sock is None:
+            return
+        self.lock.acquire()
+        try:
+            if path == self.path and self.sock is None:
+                self.sock = sock
+                self.buffer = ''
+            else:
+                # storageSocket was changed before the reload.
+                sock.close()
+        finally:
+            self.lock.release()
+
+    def _readline(self):
+        while '\n' not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise socket.error('karmad closed the connection')
+            self.buffer += data
+        (line, self.buffer) = self.buffer.split('\n', 1)
+        return line
+
+    def callMany(self, calls):
+        self.lock.acquire()
+        try:
+            try:
+                if self.sock is None:
+                    self._connect()
+                requests = []
+                for (op, args) in calls:
+                    self.nextId += 1
+                    requests.append(toWire({'id': self.nextId, 'op': op,
+                                            'args': list(args)}))
+                self.sock.sendall('\n'.join(requests) + '\n')
+                responses = [fromWire(self._readline()) for _ in requests]
+            except socket.error:
+                # The stream is in an unknown state; reconnect next time.
+                self.close()
+                raise
+        finally:
+            self.lock.release()
+        results = []
+        for response in responses:
+            if 'error' in response:
+                if response['error'] == 'ValueError':
+                    raise ValueError, response['message']
+                raise KarmadError, response['message']
+            results.append(response['result'])
+        return results
+
+    def call(self, op, *args):
+        return self.callMany([(op, args)])[0]
+
+_karmadClients = {}
+def getKarmadClient():
+    path = conf.supybot.plugins.NewKarma.storageSocket()
+    if not path:
+        path = conf.supybot.directories.data.dirize('karmad.sock')
+    if path not in _karmadClients:
+        _karmadClients[path] = KarmadClient(path)
+    return _karmadClients[path]
+
+class SocketKarmaDB(object):
+    """Karma storage owned by a karmad daemon (see karmad.py), so that
+    several bots can share the same databases."""
+    def __init__(self, filename):
+        self.client = getKarmadClient()
+
+    def close(self):
+        self.client.close()
+
+    def flush(self):
+        pass
+
+    def detach(self):
+        # The client is shared with SocketAliasDB, so whichever store is
+        # detached first hands over the socket.
+        return {'path': self.client.path, 'socket': self.client.detach()}
+
+    def attach(self, detached):
+        self.client.attach(detached['path'], detached['socket'])
+
+    def get(self, channel, thing):
+        return self.client.call('karma.get', channel, thing)
+
+    def gets(self, channel, things):
+        (L, neutrals) = self.client.call('karma.gets', channel, things)
+        return (map(tuple, L), neutrals)
+
+    def top(self, channel, limit):
+        return map(tuple, self.client.call('karma.top', channel, limit))
+
+    def bottom(self, channel, limit):
+        return map(tuple, self.client.call('karma.bottom', channel, limit))
+
+    def rank(self, channel, thing):
+        return self.client.call('karma.rank', channel, thing)
+
+    def size(self, channel):
+        return self.client.call('karma.size', channel)
+
+    def increment(self, channel, name):
+        self.client.call('karma.increment', channel, name)
+
+    def decrement(self, channel, name):
+        self.client.call('karma.decrement', channel, name)
+
+    def garbageCollect(self, channel, name):
+        self.client.call('karma.garbageCollect', channel, name)
+
+    def applyChanges(self, channel, changes):
+        return self.client.call('karma.applyChanges', channel, changes)
+
+    def most(self, channel, kind, limit):
+        return map(tuple, self.client.call('karma.most', channel, kind, limit))
+
+    def clear(self, channel, name):
+        self.client.call('karma.clear', channel, name)
+
+    def stats(self, channel):
+        stats = self.client.call('karma.stats', channel)
+        for key in ('percentiles', 'histogram'):
+            if key in stats:
+                stats[key] = map(tuple, stats[key])
+        return stats
+
+    def dump(self, channel, filename):
+        # The file is written in the daemon's data directory.
+        self.client.call('karma.dump', channel, filename)
+
+    def load(self, channel, filename):
+        self.client.call('karma.load', channel, filename)
+
+class SocketAliasDB(object):
+    """Alias storage owned by a karmad daemon; see SocketKarmaDB."""
+    def __init__(self, filename):
+        self.client = getKarmadClient()
+
+    def close(self):
+        self.client.close()
+
+    def flush(self):
+        pass
+
+    def detach(self):
+        return {'path': self.client.path, 'socket': self.client.detach()}
+
+    def attach(self, detached):
+        self.client.attach(detached['path'], detached['socket'])
+
+    def get_aliases(self, channel, thing):
+        return self.client.call('alias.get_aliases', channel, thing)
+
+    def get(self, channel, thing):
+        return self.client.call('alias.get', channel, thing)
+
+    def alias(self, channel, name, alias):
+        self.client.call('alias.alias', channel, name, alias)
+
+    def unalias(self, channel, name, alias):
+        self.client.call('alias.unalias', channel, name, alias)
+
+    def dump(self, channel, filename):
+        self.client.call('alias.dump', channel, filename)
+
+    def load(self, channel, filename):
+        self.client.call('alias.load', channel, filename)
 
 
 KarmaDB = plugins.DB('Karma',
-                     {'sqlite3': SqliteKarmaDB})
+                     {'sqlite3': SqliteKarmaDB,
+                      'journal': JournalKarmaDB,
+                      'karmad': SocketKarmaDB})
 AliasDB = plugins.DB('KarmaAliases',
-                     {'sqlite3': SqliteAliasDB})
+                     {'sqlite3': SqliteAliasDB,
+                      'karmad': SocketAliasDB})
+
+def normalizeThing(thing):
+    assert thing
+    if thing[0] == '(' and thing[-1] == ')':
+        thing = thing[1:-1]
+    return thing
+
+def parseKarma(text, users=()):
+    """Returns a (thing, direction) pair, direction being 'up' or 'down', for
+    each karma change in text.  users are the nicks in the channel, which
+    keeps nicks that end in "--" from losing karma just by being named."""
+    L = []
+    for thing in text.split():
+        if "++" in thing:
+            thing = thing.split("++")[0]
+            if thing:
+                L.append((thing, 'up'))
+        #decrement unless some person has "--" in their name in channel
+        elif "--" in thing and thing not in users:
+            #Hack for users with "--" in their name being given negative karma
+            if thing[0:-2] in users:
+                thing = thing[0:-2]
+            else:
+                thing = thing.split("--")[0]
+            if thing:
+                L.append((thing, 'down'))
+    return L
+
+def parseAlias(text, phrase):
+    """Returns (name, alias) from "<name> <phrase> <alias>"."""
+    name = text.split(phrase)[0].split()[-1]
+    alias = text.split(phrase)[1].split()[0]
+    return (name, alias)
+
+def isSelfRating(thing, nick, targets):
+    # Adjusting your own karma through a group alias is allowed.
+    return ircutils.strEqual(thing, nick) and len(targets) == 1
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'last', 'rate', 'burst')
+    def __init__(self, rate, burst, now):
+        self.tokens = burst
+        self.last = now
+        self.rate = rate
+        self.burst = burst
+
+    def refill(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(burst, self.tokens + (now - self.last) * rate)
+        self.last = now
+
+    def full(self, now):
+        return self.tokens + (now - self.last) * self.rate >= self.burst
+
+class KarmaLimiter(object):
+    """Token buckets limiting karma changes per nick, per target and per
+    channel, checked in memory before any store is touched.  counters keeps,
+    per channel, how many changes were allowed, dropped and folded, and how
+    often each kind of limit was hit."""
+    kinds = ('nick', 'target', 'channel')
+    maxBuckets = 10000
+    def __init__(self):
+        self.buckets = {}
+        self.counters = ircutils.IrcDict()
+        # Pruning walks every bucket.  When a flood from many nicks or
+        # targets leaves most of them in use, the next prune waits until the
+        # table has doubled, rather than walking it again on every check.
+        self.pruneAt = 0
+
+    def count(self, channel, counter):
+        if channel not in self.counters:
+            self.counters[channel] = dict.fromkeys(('allowed', 'dropped',
+                                                    'folded') + self.kinds, 0)
+        self.counters[channel][counter] += 1
+
+    def check(self, channel, limits, nick=None, target=None, now=None):
+        """Takes a token from each bucket that applies, if they all have one.
+        limits is a list of (kind, rate per minute, burst).  Given nick, the
+        nick and channel limits apply; they're checked once for each change
+        said, however many things an alias spreads it to.  Given target, the
+        target limit applies; it's checked once for each thing changed, and
+        passing it counts as an allowed change.  Returns the kind of the
+        limit that was hit, or None."""
+        if now is None:
+            now = time.time()
+        keys = {}
+        if nick is not None:
+            keys['nick'] = ircutils.toLower(nick)
+            keys['channel'] = ''
+        if target is not None:
+            keys['target'] = target.lower()
+        buckets = []
+        for (kind, rate, burst) in limits:
+            if rate <= 0 or kind not in keys:
+                continue
+            rate = rate / 60.0
+            key = (ircutils.toLower(channel), kind, keys[kind])
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate, burst, now)
+                self.buckets[key] = bucket
+            else:
+                bucket.refill(rate, burst, now)
+            if bucket.tokens < 1:
+                self.count(channel, kind)
+                return kind
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.tokens -= 1
+        if target is not None:
+            self.count(channel, 'allowed')
+        if len(self.buckets) > max(self.maxBuckets, self.pruneAt):
+            self._prune(now)
+        return None
+
+    def _prune(self, now):
+        # A full bucket is no different from one that doesn't exist yet.
+        for (key, bucket) in self.buckets.items():
+            if bucket.full(now):
+                del self.buckets[key]
+        self.pruneAt = 2 * len(self.buckets)
+
+# Bump this whenever what an instance hands to its replacement on reload
+# changes; reloads across versions start cold.
+warmStateVersion = 2
+
+# What an instance dying in a reload leaves for the one replacing it: the
+# stores' connections, as their detach methods return them, and the folded
+# changes.  The guard keeps reload(plugin) from forgetting it.
+try:
+    warmState
+except NameError:
+    warmState = {}
+
+def reload():
+    """Owner's reload command calls this on the old module before loading
+    the new one, and hands what it returns to the package's reload (see
+    __init__.py), which passes it on to expectWarmState."""
+    return warmStateVersion
+
+def expectWarmState(version):
+    """Called once the new module is loaded, with the warmStateVersion of
+    the old one.  If the two match, the old instance hands its connections
+    and folded changes to the new one when it dies, rather than writing and
+    closing them."""
+    if version == warmStateVersion:
+        warmState['expected'] = True
+
+def foldedChanges(pending):
+    changes = []
+    for (name, added, subtracted) in pending.itervalues():
+        if added:
+            changes.append((name, added))
+        if subtracted:
+            changes.append((name, -subtracted))
+    return changes
+
+def closeDetached(detached):
+    """Closes the connections a store's detach returned, when there's no
+    store of the same kind to attach them to."""
+    for db in detached.get('dbs', {}).itervalues():
+        db.close()
+    for idle in detached.get('readers', {}).itervalues():
+        for db in idle:
+            db.close()
+    if detached.get('socket') is not None:
+        detached['socket'].close()
+
+def releaseWarmState(state):
+    """Closes the connections in state and writes its folded changes, for
+    when the instance meant to take them over couldn't be started."""
+    for (_, detached) in (state['db'], state['alias_db']):
+        closeDetached(detached)
+    db = KarmaDB()
+    try:
+        for (channel, pending) in state['folded'].iteritems():
+            changes = foldedChanges(pending)
+            if changes:
+                db.applyChanges(channel, changes)
+    finally:
+        db.close()
 
 class NewKarma(callbacks.Plugin):
     callBefore = ('Factoids', 'MoobotFactoids', 'Infobot')
     def __init__(self, irc):
-        self.__parent = super(NewKarma, self)
-        self.__parent.__init__(irc)
-        self.db = KarmaDB()
-        self.alias_db = AliasDB()
+        state = warmState.pop('state', None)
+        try:
+            self.__parent = super(NewKarma, self)
+            self.__parent.__init__(irc)
+            self.db = KarmaDB()
+            self.alias_db = AliasDB()
+            self.limiter = KarmaLimiter()
+            self.folded = ircutils.IrcDict()
+            if state is not None:
+                self._attach(state)
+        except:
+            if state is not None:
+                # Nothing else will close the connections or write the
+                # changes the old instance left us.
+                (E, e, tb) = sys.exc_info()
+                try:
+                    releaseWarmState(state)
+                except Exception:
+                    log.exception('Uncaught exception releasing the state '
+                                  'NewKarma was reloaded with:')
+                raise E, e, tb
+            raise
 
     def die(self):
         self.__parent.die()
+        for channel in self.folded.keys():
+            self._unscheduleFold(channel)
+        if warmState.pop('expected', False):
+            # We're being reloaded, and Owner starts the new instance right
+            # after we die.
+            warmState['state'] = self._detach()
+            return
+        for channel in self.folded.keys():
+            self._applyFolded(channel)
         self.db.close()
         self.alias_db.close()
 
-    def _normalizeThing(self, thing):
-        assert thing
-        if thing[0] == '(' and thing[-1] == ')':
-            thing = thing[1:-1]
-        return thing
+    def _detach(self):
+        return {'db': (self.db.__class__.__name__, self.db.detach()),
+                'alias_db': (self.alias_db.__class__.__name__,
+                             self.alias_db.detach()),
+                'folded': dict(self.folded.items())}
+
+    def _attach(self, state):
+        for (store, (name, detached)) in ((self.db, state['db']),
+                                          (self.alias_db, state['alias_db'])):
+            if store.__class__.__name__ == name:
+                store.attach(detached)
+            else:
+                # supybot.databases was changed before the reload.
+                closeDetached(detached)
+        self.folded.update(state['folded'])
+        for channel in self.folded:
+            self._scheduleFold(channel)
+
+    def _limits(self, channel):
+        return [(kind,
+                 self.registryValue('rateLimit.%s.rate' % kind, channel),
+                 self.registryValue('rateLimit.%s.burst' % kind, channel))
+                for kind in KarmaLimiter.kinds]
+
+    def _foldEventName(self, channel):
+        return 'NewKarma.fold.%s' % ircutils.toLower(channel)
+
+    def _scheduleFold(self, channel):
+        delay = self.registryValue('rateLimit.foldDelay', channel)
+        schedule.addEvent(lambda: self._applyFolded(channel),
+                          time.time() + delay, self._foldEventName(channel))
+
+    def _unscheduleFold(self, channel):
+        try:
+            schedule.removeEvent(self._foldEventName(channel))
+        except KeyError:
+            pass
+
+    def _fold(self, channel, name, direction):
+        if channel not in self.folded:
+            self.folded[channel] = {}
+            self._scheduleFold(channel)
+        pending = self.folded[channel]
+        if name.lower() not in pending:
+            pending[name.lower()] = [name, 0, 0]
+        if direction == 'up':
+            pending[name.lower()][1] += 1
+        else:
+            pending[name.lower()][2] += 1
+        self.limiter.count(channel, 'folded')
+
+    def _applyFolded(self, channel):
+        self._unscheduleFold(channel)
+        changes = foldedChanges(self.folded.pop(channel, {}))
+        if changes:
+            self.db.applyChanges(channel, changes)
 
     def _respond(self, irc, channel, message=None):
         if self.registryValue('response', channel):
@@ -364,84 +1708,73 @@ class NewKarma(callbacks.Plugin):
         return  message.replace('USER', name).replace('TOTAL', str(total))
 
     def _doAlias(self, irc, channel, things):
-      name = things.split('is also known as')[0].split()[-1]
-      alias = things.split('is also known as')[1].split()[0]
+      (name, alias) = parseAlias(things, 'is also known as')
       self.alias_db.alias(channel, name, alias)
       irc.reply("%s is also %s, got it!" % (name, alias))
 
     def _doUnalias(self, irc, channel, things):
-      name = things.split('is no longer known as')[0].split()[-1]
-      alias = things.split('is no longer known as')[1].split()[0]
+      (name, alias) = parseAlias(things, 'is no longer known as')
       self.alias_db.unalias(channel, name, alias)
       irc.reply("Who?  I've forgotten that %s was ever %s!" % (name, alias))
 
     def _doKarma(self, irc, channel, things):
-      for thing in things.split():
-        originalthing = None
-        #if thing.endswith('++'):
-        if "++" in thing:
-            thing = thing.split("++")[0]
-            if thing:
-              #see if what we are incrementing is an alias for someone
-              aliasfor = self.alias_db.get(channel, self._normalizeThing(thing))
-              if aliasfor:
+        try:
+            users = irc.state.channels[channel].users
+        except KeyError:
+            users = ()
+        allowSelfRating = self.registryValue('allowSelfRating', channel)
+        limits = self._limits(channel)
+        # (thing, alias it was reached through, direction) for each change
+        # to make, or None for a refused self-rating.
+        pending = []
+        for (thing, direction) in parseKarma(things, users):
+            originalthing = None
+            #see if what we are changing is an alias for someone
+            targets = self.alias_db.get(channel, normalizeThing(thing))
+            if targets:
                 originalthing = thing
-                thing = aliasfor
-              if type(thing) != list:
-                thing = [thing]
-              for athing in thing:
-                #Honor allowSelfRating unless this is a group alias
-                if ircutils.strEqual(athing, irc.msg.nick) and \
-                   not self.registryValue('allowSelfRating', channel) and \
-                   len(thing) == 1:
-                  irc.error('You\'re not allowed to adjust your own karma.')
-                else:
-                  self.db.increment(channel, self._normalizeThing(athing))
-                  t = self.db.get(channel, athing)
-                  if t is None:
-                    total = 0
-                  else:
-                    (added, subtracted) = t
-                    total = added - subtracted
-                  if total == 0:
-                    self._respond(irc, channel, self._parseKarmaMessage(athing, total, channel, originalthing, "none"))
-	            self.db.garbageCollect(channel, athing)
-                  else:
-                    self._respond(irc, channel, self._parseKarmaMessage(athing, total, channel, originalthing, "up"))
-        #decrement unless some person has "--" in their name in channel
-        elif "--" in thing and thing not in irc.state.channels[channel].users:
-            #Hack for users with "--" in their name being given negative karma
-            if thing[0:-2] in irc.state.channels[channel].users:
-                thing = thing[0:-2]
             else:
-                thing = thing.split("--")[0]
-            if thing:
-              #see if what we are incrementing is an alias for someone
-              aliasfor = self.alias_db.get(channel, self._normalizeThing(thing))
-              if aliasfor:
-                originalthing = thing
-                thing = aliasfor
-              if type(thing) != list:
-                thing = [thing]
-              for athing in thing:
-                #Honor allowSelfRating unless this is a group alias
-                if ircutils.strEqual(athing, irc.msg.nick) and \
-                   not self.registryValue('allowSelfRating', channel) and \
-                   len(thing) == 1:
-                  irc.error('You\'re not allowed to adjust your own karma.')
+                targets = [thing]
+            # Only a lone target can be refused, and a refused change costs
+            # the speaker none of their limits.
+            if not allowSelfRating and \
+               isSelfRating(targets[0], irc.msg.nick, targets):
+                pending.append(None)
+                continue
+            limited = self.limiter.check(channel, limits, nick=irc.msg.nick)
+            for athing in targets:
+                if limited or \
+                   self.limiter.check(channel, limits,
+                                      target=normalizeThing(athing)):
+                    if self.registryValue('rateLimit.fold', channel):
+                        self._fold(channel, normalizeThing(athing), direction)
+                    else:
+                        self.limiter.count(channel, 'dropped')
+                    irc.noReply()
+                    continue
+                pending.append((athing, originalthing, direction))
+        # Every change in the line goes to the store at once, so a whole
+        # group alias costs a single commit.
+        changes = []
+        for change in pending:
+            if change is not None:
+                (athing, _, direction) = change
+                if direction == 'up':
+                    changes.append((normalizeThing(athing), 1))
                 else:
-                  self.db.decrement(channel, self._normalizeThing(athing))
-                  t = self.db.get(channel, athing)
-                  if t is None:
-                    total = 0
-                  else:
-                    (added, subtracted) = t
-                    total = added - subtracted
-                  if total == 0:
-                    self._respond(irc, channel, self._parseKarmaMessage(athing, total, channel, originalthing, "none"))
-	            self.db.garbageCollect(channel, athing)
-                  else:
-                    self._respond(irc, channel, self._parseKarmaMessage(athing, total, channel, originalthing, "down"))
+                    changes.append((normalizeThing(athing), -1))
+        if changes:
+            results = iter(self.db.applyChanges(channel, changes))
+        for change in pending:
+            if change is None:
+                irc.error('You\'re not allowed to adjust your own karma.')
+                continue
+            (athing, originalthing, direction) = change
+            (added, subtracted) = results.next()
+            total = added - subtracted
+            if total == 0:
+                direction = 'none'
+            self._respond(irc, channel, self._parseKarmaMessage(athing, total, channel, originalthing, direction))
 
     def invalidCommand(self, irc, msg, tokens):
         channel = msg.args[0]
@@ -489,7 +1822,7 @@ class NewKarma(callbacks.Plugin):
             irc.reply("%s doesn't have any aliases!" % (name))
         else:
           irc.reply("Give me *something*!  A nick, a word, anything!")
-    showaliases = wrap(showaliases, ['channel', any('something')])
+    showaliases = thread(wrap(showaliases, ['channel', any('something')]))
 
     def karma(self, irc, msg, args, channel, things):
         """[<channel>] [<thing> ...]
@@ -548,7 +1881,7 @@ class NewKarma(callbacks.Plugin):
             s = format('Highest karma: %L.  Lowest karma: %L.%s',
                        highest, lowest, rankS)
             irc.reply(s, prefixNick=False)
-    karma = wrap(karma, ['channel', any('something')])
+    karma = thread(wrap(karma, ['channel', any('something')]))
 
     _mostAbbrev = utils.abbrev(['increased', 'decreased', 'active'])
     def most(self, irc, msg, args, channel, kind):
@@ -565,8 +1898,54 @@ class NewKarma(callbacks.Plugin):
             irc.reply(format('%L', L))
         else:
             irc.error('I have no karma for this channel.')
-    most = wrap(most, ['channel',
-                       ('literal', ['increased', 'decreased', 'active'])])
+    most = thread(wrap(most, ['channel',
+                       ('literal', ['increased', 'decreased', 'active'])]))
+
+    def stats(self, irc, msg, args, channel, kind):
+        """[<channel>] {distribution,load}
+
+        With distribution, returns the mean, median, percentiles and a
+        histogram of the karma totals in <channel>.  With load, returns how
+        many karma changes the rate limits have let through, dropped and
+        folded.  <channel> is only necessary if the message isn't sent in the
+        channel itself.
+        """
+        if kind == 'load':
+            self._loadStats(irc, channel)
+            return
+        stats = self.db.stats(channel)
+        if not stats['count']:
+            irc.error('I have no karma for this channel.')
+            return
+        percentiles = [format('p%s: %s', p, total)
+                       for (p, total) in stats['percentiles']]
+        histogram = [format('%s..%s: %s', low, high, count)
+                     for (low, high, count) in stats['histogram']]
+        s = format('%n; mean %s, standard deviation %s, median %s, '
+                   'lowest %s, highest %s.  Percentiles: %L.  '
+                   'Histogram: %L.',
+                   (stats['count'], 'thing'), '%.2f' % stats['mean'],
+                   '%.2f' % stats['stddev'], stats['median'], stats['min'],
+                   stats['max'], percentiles, histogram)
+        irc.reply(s)
+    stats = thread(wrap(stats, ['channel',
+                                ('literal', ['distribution', 'load'])]))
+
+    def _loadStats(self, irc, channel):
+        counters = self.limiter.counters.get(channel)
+        if counters is None:
+            counters = dict.fromkeys(('allowed', 'dropped', 'folded') +
+                                     KarmaLimiter.kinds, 0)
+        pending = sum([added + subtracted for (_, added, subtracted)
+                       in self.folded.get(channel, {}).itervalues()])
+        irc.reply(format('%n allowed, %n dropped and %n folded.  Limits hit: '
+                         'nick %i, target %i, channel %i.  %n waiting to be '
+                         'applied.',
+                         (counters['allowed'], 'karma change'),
+                         (counters['dropped'], 'karma change'),
+                         (counters['folded'], 'karma change'),
+                         counters['nick'], counters['target'],
+                         counters['channel'], (pending, 'folded change')))
 
     def clear(self, irc, msg, args, channel, name):
         """[<channel>] <name>
@@ -586,7 +1965,8 @@ class NewKarma(callbacks.Plugin):
         """
         self.db.dump(channel, filename)
         irc.replySuccess()
-    dump = wrap(dump, [('checkCapability', 'owner'), 'channeldb', 'filename'])
+    dump = thread(wrap(dump, [('checkCapability', 'owner'), 'channeldb',
+                              'filename']))
 
     def load(self, irc, msg, args, channel, filename):
         """[<channel>] <filename>
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Rebuilds a channel's karma and aliases from its ChannelLogger logs, offline.
+
+Each log file is scanned in a separate process, using the same rules as the
+plugin (plugin.parseKarma and plugin.parseAlias), into counts of
+(thing, nick, direction).  Those counts are then merged, resolved through
+the aliases set up in the logs, and loaded into the channel's stores in one
+transaction.
+
+Three things are approximated:
+
+  * Aliases are resolved as they stand at the end of the logs, not as they
+    stood when each line was said.
+  * The bot forgets a thing whenever its karma drops back to zero, resetting
+    its "increased" and "decreased" counts; the rebuild only drops things
+    that end at zero.  Totals are exact, but the counts behind them may be
+    higher than a live bot's.
+  * Each file starts with nobody in the channel, as only the joins, parts
+    and messages in that file are seen.  A nick with "--" in it that is
+    named before it speaks or joins again in a later file loses karma, where
+    the bot would have left it alone.
+
+With --checkpoint, the result of each finished file is kept in the given
+directory, and a rerun skips files that haven't changed since.
+
+Usage: rebuild.py --directory DATA --channel '#chan' [options] LOGFILE ...
+"""
+
+import os
+import re
+import sys
+import time
+import pickle
+import optparse
+import multiprocessing
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1 # for python2.4
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import supybot.conf as conf
+import supybot.ircutils as ircutils
+
+import plugin
+
+# ChannelLogger's default format: "2015-11-10T12:34:56  <nick> text".
+messageRe = re.compile(r'^.*?  <(?P<nick>[^>\s]+)> (?P<text>.*)$')
+joinRe = re.compile(r'^.*?  \*\*\* (?P<nick>\S+) <[^>]*> has joined')
+leaveRe = re.compile(r'^.*?  \*\*\* (?P<nick>\S+) <[^>]*> has (left|quit)')
+nickRe = re.compile(r'^.*?  \*\*\* (?P<old>\S+) is now known as (?P<new>\S+)')
+
+class Options(object):
+    """The settings a scan needs; kept picklable for the process pool."""
+    def __init__(self, botnick, unaddressed):
+        self.botnick = botnick
+        self.unaddressed = unaddressed
+
+def addressedText(text, botnick):
+    if not botnick:
+        return None
+    for sep in (':', ','):
+        prefix = botnick + sep
+        if ircutils.toLower(text[:len(prefix)]) == ircutils.toLower(prefix):
+            return text[len(prefix):].strip()
+    return None
+
+def scanLog(args):
+    """Scans one log file.  Returns (counts, aliases, lines), where counts
+    maps (thing, lowercased nick, direction) to how often it happened and
+    aliases lists ('alias' or 'unalias', name, alias) in log order."""
+    (filename, options) = args
+    counts = {}
+    aliases = []
+    users = ircutils.IrcSet()
+    lines = 0
+    fd = file(filename)
+    try:
+        for line in fd:
+            lines += 1
+            line = line.rstrip('\r\n')
+            m = messageRe.match(line)
+            if m is None:
+                m = joinRe.match(line)
+                if m is not None:
+                    users.add(m.group('nick'))
+                    continue
+                m = leaveRe.match(line)
+                if m is not None:
+                    users.discard(m.group('nick'))
+                    continue
+                m = nickRe.match(line)
+                if m is not None:
+                    users.discard(m.group('old'))
+                    users.add(m.group('new'))
+                continue
+            (nick, text) = (m.group('nick'), m.group('text').rstrip())
+            users.add(nick)
+            addressed = addressedText(text, options.botnick)
+            if addressed is not None:
+                # The plugin only sees these through invalidCommand.
+                tokens = addressed.split()
+                if not tokens or tokens[-1][-2:] not in ('++', '--'):
+                    continue
+                text = addressed
+            elif options.unaddressed:
+                for (kind, phrase) in (('alias', 'is also known as'),
+                                       ('unalias', 'is no longer known as')):
+                    if phrase in text:
+                        try:
+                            (name, alias) = plugin.parseAlias(text, phrase)
+                        except IndexError:
+                            continue
+                        aliases.append((kind, name, alias))
+            else:
+                continue
+            for (thing, direction) in plugin.parseKarma(text, users):
+                key = (thing, nick.lower(), direction)
+                counts[key] = counts.get(key, 0) + 1
+    finally:
+        fd.close()
+    return (counts, aliases, lines)
+
+class Checkpoint(object):
+    def __init__(self, directory):
+        self.directory = directory
+        if directory is not None and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _key(self, filename):
+        st = os.stat(filename)
+        return (os.path.abspath(filename), st.st_size, st.st_mtime)
+
+    def _path(self, filename):
+        return os.path.join(self.directory,
+                            sha1(os.path.abspath(filename)).hexdigest())
+
+    def get(self, filename):
+        if self.directory is None:
+            return None
+        path = self._path(filename)
+        if not os.path.exists(path):
+            return None
+        fd = file(path, 'rb')
+        try:
+            (key, result) = pickle.load(fd)
+        finally:
+            fd.close()
+        if key != self._key(filename):
+            return None
+        return result
+
+    def put(self, filename, result):
+        if self.directory is None:
+            return
+        path = self._path(filename)
+        fd = file(path + '.tmp', 'wb')
+        try:
+            pickle.dump((self._key(filename), result), fd, 2)
+        finally:
+            fd.close()
+        os.rename(path + '.tmp', path)
+
+def scanAll(filenames, options, processes, checkpoint, out=sys.stderr):
+    results = {}
+    todo = []
+    for filename in filenames:
+        result = checkpoint.get(filename)
+        if result is None:
+            todo.append(filename)
+        else:
+            results[filename] = result
+    if results:
+        out.write('Resuming: %s of %s files already scanned.\n' %
+                  (len(results), len(filenames)))
+    if todo:
+        pool = multiprocessing.Pool(processes)
+        try:
+            work = [(filename, options) for filename in todo]
+            for (filename, result) in zip(todo, pool.imap(scanLog, work)):
+                checkpoint.put(filename, result)
+                results[filename] = result
+                out.write('Scanned %s (%s lines).\n' % (filename, result[2]))
+        finally:
+            pool.close()
+            pool.join()
+    return [results[filename] for filename in filenames]
+
+def merge(results, allowSelfRating=False, aliasRows=()):
+    """Merges the per-file results, in log order, into karma rows of (name,
+    added, subtracted) and alias rows of (name, alias)."""
+    aliasRows = list(aliasRows)
+    counts = {}
+    for (partial, aliases, _) in results:
+        for (key, n) in partial.iteritems():
+            counts[key] = counts.get(key, 0) + n
+        for (kind, name, alias) in aliases:
+            if kind == 'alias':
+                aliasRows.append((name, alias))
+            else:
+                aliasRows = [(n, a) for (n, a) in aliasRows
+                             if (n.lower(), a) != (name.lower(), alias)]
+    closure = plugin.AliasClosure(aliasRows)
+    karma = {}
+    for ((thing, nick, direction), n) in counts.iteritems():
+        targets = closure.resolve(plugin.normalizeThing(thing)) or [thing]
+        for target in targets:
+            if not allowSelfRating and \
+               plugin.isSelfRating(target, nick, targets):
+                continue
+            name = plugin.normalizeThing(target)
+            row = karma.setdefault(name.lower(), [name, 0, 0])
+            if direction == 'up':
+                row[1] += n
+            else:
+                row[2] += n
+    rows = [tuple(row) for row in karma.itervalues() if row[1] != row[2]]
+    return (rows, aliasRows)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] LOGFILE ...')
+    parser.add_option('--directory', default='data',
+                      help="The bot's data directory.")
+    parser.add_option('--channel', help='The channel to rebuild.')
+    parser.add_option('--database', choices=['sqlite3', 'journal'],
+                      default='sqlite3',
+                      help='The karma backend to load into, sqlite3 or '
+                           'journal.  karmad keeps its data in the sqlite3 '
+                           'files, so use sqlite3 with karmad stopped.')
+    parser.add_option('--nick', default='',
+                      help="The bot's nick, to recognize addressed karma.")
+    parser.add_option('--unaddressed', action='store_true', default=False,
+                      help='Count unaddressed karma and alias phrases, as '
+                           'with allowUnaddressedKarma.')
+    parser.add_option('--allow-self-rating', action='store_true',
+                      default=False, dest='allowSelfRating')
+    parser.add_option('--keep-aliases', action='store_true', default=False,
+                      dest='keepAliases',
+                      help='Start from the aliases already in the channel '
+                           'rather than only those in the logs.')
+    parser.add_option('--processes', type='int', default=None,
+                      help='Worker processes; defaults to one per CPU.')
+    parser.add_option('--checkpoint', default=None,
+                      help='Directory to keep per-file results in, so that '
+                           'an interrupted rebuild can resume.')
+    (options, filenames) = parser.parse_args()
+    if not options.channel or not filenames:
+        parser.error('--channel and at least one log file are required.')
+    conf.supybot.directories.data.setValue(options.directory)
+    # Aliases are always kept in sqlite3.
+    conf.supybot.databases.setValue([options.database, 'sqlite3'])
+    start = time.time()
+    results = scanAll(filenames, Options(options.nick, options.unaddressed),
+                      options.processes, Checkpoint(options.checkpoint))
+    karmaDb = plugin.KarmaDB()
+    aliasDb = plugin.AliasDB()
+    try:
+        aliasRows = ()
+        if options.keepAliases:
+            aliasRows = aliasDb.pairs(options.channel)
+        (rows, aliasRows) = merge(results, options.allowSelfRating,
+                                  aliasRows)
+        karmaDb.loadRows(options.channel, rows)
+        aliasDb.loadRows(options.channel, aliasRows)
+    finally:
+        karmaDb.close()
+        aliasDb.close()
+    sys.stderr.write('Loaded %s things and %s aliases into %s in %.1fs.\n' %
+                     (len(rows), len(aliasRows), options.channel,
+                      time.time() - start))
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
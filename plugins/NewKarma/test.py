@@ -207,4 +207,984 @@ class KarmaTestCase(ChannelPluginTestCase):
             karma.response.setValue(resp)
             karma.allowUnaddressedKarma.setValue(unaddressed)
 
+class NewKarmaTestCase(ChannelPluginTestCase):
+    plugins = ('NewKarma',)
+    def setUp(self):
+        self.databases = conf.supybot.databases()
+        conf.supybot.databases.setValue(['sqlite3'])
+        ChannelPluginTestCase.setUp(self)
+        group = conf.supybot.plugins.NewKarma
+        self.settings = [group.response, group.allowUnaddressedKarma,
+                         group.rateLimit.fold]
+        for kind in ('nick', 'target', 'channel'):
+            self.settings.append(group.rateLimit.get(kind).rate)
+            self.settings.append(group.rateLimit.get(kind).burst)
+        self.settings = [(value, value()) for value in self.settings]
+        group.response.setValue(True)
+        group.allowUnaddressedKarma.setValue(True)
+
+    def tearDown(self):
+        ChannelPluginTestCase.tearDown(self)
+        for (value, original) in self.settings:
+            value.setValue(original)
+        conf.supybot.databases.setValue(self.databases)
+
+    def limit(self, kind, burst):
+        # A token a minute, so nothing refills while the test runs.
+        group = conf.supybot.plugins.NewKarma.rateLimit.get(kind)
+        group.rate.setValue(1.0)
+        group.burst.setValue(burst)
+
+    def testGroupAliasChargesNickOnce(self):
+        cb = self.irc.getCallback('NewKarma')
+        for i in range(30):
+            cb.alias_db.alias(self.channel, 'dev%s' % i, 'devs')
+        conf.supybot.plugins.NewKarma.response.setValue(False)
+        self.assertSnarfNoResponse('devs++')
+        self.assertEqual(cb.db.size(self.channel), 30)
+        counters = cb.limiter.counters[self.channel]
+        self.assertEqual(counters['allowed'], 30)
+        self.assertEqual(counters['dropped'], 0)
+        self.assertEqual(counters['nick'], 0)
+
+    def testLineAppliedAtOnceInOrder(self):
+        cb = self.irc.getCallback('NewKarma')
+        for name in ('bob', 'test', 'alice'):
+            cb.alias_db.alias(self.channel, name, 'devs')
+        calls = []
+        applyChanges = cb.db.applyChanges
+        def recordingApplyChanges(channel, changes):
+            calls.append(changes)
+            return applyChanges(channel, changes)
+        cb.db.applyChanges = recordingApplyChanges
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel,
+                                         'foo++ test++ devs-- bar++',
+                                         prefix=self.prefix))
+        replies = []
+        m = self.irc.takeMsg()
+        while m is not None:
+            replies.append(m.args[1])
+            m = self.irc.takeMsg()
+        expected = [r'^foo now has 1 point',
+                    r'not allowed to adjust your own karma',
+                    r'^devs \(alice\) now has -1 point',
+                    r'^devs \(bob\) now has -1 point',
+                    # Through a group alias, your own karma may change.
+                    r'^devs \(test\) now has -1 point',
+                    r'^bar now has 1 point']
+        self.assertEqual(len(replies), len(expected), replies)
+        for (reply, regexp) in zip(replies, expected):
+            self.failUnless(re.search(regexp, reply), (regexp, reply))
+        self.assertEqual(calls, [[('foo', 1), ('alice', -1), ('bob', -1),
+                                  ('test', -1), ('bar', 1)]])
+
+    def testSelfRatingCostsNothing(self):
+        self.limit('nick', 1)
+        self.limit('channel', 1)
+        for _ in range(3):
+            self.assertSnarfRegexp('test++', 'not allowed')
+        self.assertSnarfRegexp('foo++', 'foo now has 1 point')
+        self.assertRegexp('stats load', '1 karma change allowed, 0 karma '
+                          'changes dropped.*nick 0, target 0, channel 0')
+
+    def testDropped(self):
+        self.limit('nick', 2)
+        self.assertSnarfRegexp('foo++', 'foo now has 1 point')
+        self.assertSnarfRegexp('foo++', 'foo now has 2 points')
+        self.assertSnarfNoResponse('foo++')
+        cb = self.irc.getCallback('NewKarma')
+        self.assertEqual(cb.db.get(self.channel, 'foo'), [2, 0])
+        self.assertRegexp('stats load',
+                          r'2 karma changes allowed, 1 karma change dropped '
+                          r'and 0 karma changes folded.*nick 1, target 0')
+
+    def testTargetLimitCountsEachThing(self):
+        self.limit('target', 1)
+        cb = self.irc.getCallback('NewKarma')
+        cb.alias_db.alias(self.channel, 'foo', 'both')
+        cb.alias_db.alias(self.channel, 'bar', 'both')
+        self.assertSnarfRegexp('foo++', 'foo now has 1 point')
+        # foo has had its change; bar hasn't.
+        self.assertSnarfRegexp('both++', r'both \(bar\) now has 1 point')
+        self.assertSnarfNoResponse('both++')
+        self.assertEqual(cb.db.get(self.channel, 'foo'), [1, 0])
+        self.assertEqual(cb.db.get(self.channel, 'bar'), [1, 0])
+
+    def testFolded(self):
+        self.limit('nick', 1)
+        conf.supybot.plugins.NewKarma.rateLimit.fold.setValue(True)
+        self.assertSnarfRegexp('foo++', 'foo now has 1 point')
+        self.assertSnarfNoResponse('foo++ bar-- foo++')
+        cb = self.irc.getCallback('NewKarma')
+        self.assertEqual(cb.db.get(self.channel, 'foo'), [1, 0])
+        self.assertRegexp('stats load', r'3 karma changes folded.*'
+                          r'nick 3.*3 folded changes waiting')
+        cb._applyFolded(self.channel)
+        self.assertEqual(cb.db.get(self.channel, 'foo'), [3, 0])
+        self.assertEqual(cb.db.get(self.channel, 'bar'), [0, 1])
+        self.assertRegexp('stats load', '0 folded changes waiting')
+
+
+class NewKarmaReloadTestCase(ChannelPluginTestCase):
+    plugins = ('NewKarma',)
+    def setUp(self):
+        self.databases = conf.supybot.databases()
+        conf.supybot.databases.setValue(['sqlite3'])
+        ChannelPluginTestCase.setUp(self)
+        conf.supybot.plugins.NewKarma.response.setValue(True)
+        conf.supybot.plugins.NewKarma.allowUnaddressedKarma.setValue(True)
+
+    def tearDown(self):
+        ChannelPluginTestCase.tearDown(self)
+        conf.supybot.plugins.NewKarma.response.setValue(False)
+        conf.supybot.plugins.NewKarma.allowUnaddressedKarma.setValue(False)
+        conf.supybot.databases.setValue(self.databases)
+
+    def testReloadHandsOverWarmState(self):
+        self.assertSnarfRegexp('bob is also known as rob', 'got it')
+        self.assertSnarfRegexp('rob++', r'rob \(bob\) now has 1 point')
+        cb = self.irc.getCallback('NewKarma')
+        writer = cb.db._getDb(self.channel)
+        closure = cb.alias_db._getClosure(self.channel)
+        cb.folded[self.channel] = {'foo': ['foo', 2, 0]}
+        cb._scheduleFold(self.channel)
+        self.assertNotError('reload NewKarma')
+        new = self.irc.getCallback('NewKarma')
+        self.failIf(new is cb)
+        module = sys.modules[new.__module__]
+        self.failIf('state' in module.warmState)
+        # The connection is handed over; what was built from it is not.
+        self.failUnless(new.db._getDb(self.channel) is writer)
+        newClosure = new.alias_db._getClosure(self.channel)
+        self.failIf(newClosure is closure)
+        self.failUnless(newClosure.__class__ is module.AliasClosure)
+        self.assertEqual(new.folded[self.channel], {'foo': ['foo', 2, 0]})
+        new._applyFolded(self.channel)
+        self.assertRegexp('karma foo', 'increased 2 times')
+        self.assertSnarfRegexp('rob++', r'rob \(bob\) now has 2 points')
+
+    def testReloadFromVersionWithoutHook(self):
+        cb = self.irc.getCallback('NewKarma')
+        module = sys.modules[cb.__module__]
+        writer = cb.db._getDb(self.channel)
+        cb.folded[self.channel] = {'foo': ['foo', 2, 0]}
+        cb._scheduleFold(self.channel)
+        del module.reload
+        self.assertNotError('reload NewKarma')
+        new = self.irc.getCallback('NewKarma')
+        self.failIf(new is cb)
+        self.failUnless(hasattr(module, 'reload'))
+        self.failIf(new.db._getDb(self.channel) is writer)
+        self.assertRaises(module.sqlite3.ProgrammingError, writer.cursor)
+        self.assertRegexp('karma foo', 'increased 2 times')
+        # The next reload hands over as usual.
+        writer = new.db._getDb(self.channel)
+        self.assertNotError('reload NewKarma')
+        self.failUnless(self.irc.getCallback('NewKarma').db._getDb(
+                            self.channel) is writer)
+
+    def testFailedReloadReleasesWarmState(self):
+        cb = self.irc.getCallback('NewKarma')
+        module = sys.modules[cb.__module__]
+        writer = cb.db._getDb(self.channel)
+        cb.folded[self.channel] = {'foo': ['foo', 2, 1]}
+        cb._scheduleFold(self.channel)
+        # What Owner's reload command does, up to starting the new instance.
+        self.irc.removeCallback('NewKarma')
+        module.expectWarmState(module.reload())
+        cb.die()
+        self.failUnless('state' in module.warmState)
+        KarmaLimiter = module.KarmaLimiter
+        module.KarmaLimiter = None
+        try:
+            self.assertRaises(TypeError, module.Class, self.irc)
+        finally:
+            module.KarmaLimiter = KarmaLimiter
+        self.failIf('state' in module.warmState)
+        self.assertRaises(module.sqlite3.ProgrammingError, writer.cursor)
+        self.irc.addCallback(module.Class(self.irc))
+        self.assertRegexp('karma foo', 'increased 2 times.*decreased 1 time')
+
+
+class KarmadTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        import tempfile
+        import subprocess
+        import NewKarma.plugin
+        self.plugin = NewKarma.plugin
+        self.directory = tempfile.mkdtemp()
+        self.socket = os.path.join(self.directory, 'karmad.sock')
+        # The daemon runs in its own directory, so plugin.__file__, which is
+        # relative when the tests are run as supybot-test plugins/NewKarma,
+        # won't do.
+        karmad = os.path.join(os.path.dirname(
+                                  os.path.abspath(self.plugin.__file__)),
+                              'karmad.py')
+        self.daemon = subprocess.Popen([sys.executable, karmad,
+                                        '--socket', self.socket,
+                                        '--directory', self.directory],
+                                       cwd=self.directory)
+        for _ in range(100):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.05)
+        else:
+            # tearDown isn't run when setUp fails.
+            self.daemon.terminate()
+            self.daemon.wait()
+            import shutil
+            shutil.rmtree(self.directory)
+            self.fail('karmad (%s) did not create %s within 5 seconds.' %
+                      (karmad, self.socket))
+        self.original = conf.supybot.plugins.NewKarma.storageSocket()
+        conf.supybot.plugins.NewKarma.storageSocket.setValue(self.socket)
+        self.db = self.plugin.SocketKarmaDB('Karma.karmad.db')
+        self.aliases = self.plugin.SocketAliasDB('KarmaAliases.karmad.db')
+
+    def tearDown(self):
+        self.db.close()
+        self.daemon.terminate()
+        self.daemon.wait()
+        conf.supybot.plugins.NewKarma.storageSocket.setValue(self.original)
+        import shutil
+        shutil.rmtree(self.directory)
+        SupyTestCase.tearDown(self)
+
+    def testDetachHandsOverSocket(self):
+        self.db.increment('#test', 'foo')
+        sock = self.db.client.sock
+        detached = [self.db.detach(), self.aliases.detach()]
+        self.failUnless(detached[0]['socket'] is sock)
+        # The stores share a client, so only one of them has the socket.
+        self.failUnless(detached[1]['socket'] is None)
+        # A reload starts over with no clients.
+        self.plugin._karmadClients.clear()
+        db = self.plugin.SocketKarmaDB('Karma.karmad.db')
+        aliases = self.plugin.SocketAliasDB('KarmaAliases.karmad.db')
+        try:
+            db.attach(detached[0])
+            aliases.attach(detached[1])
+            self.failUnless(db.client.sock is sock)
+            self.assertEqual(db.get('#test', 'foo'), [1, 0])
+        finally:
+            db.close()
+
+    def testKarma(self):
+        self.assertEqual(self.db.get('#test', 'foo'), None)
+        self.db.increment('#test', 'foo')
+        self.db.increment('#test', 'Foo')
+        self.db.decrement('#test', 'bar')
+        self.assertEqual(self.db.get('#test', 'FOO'), [2, 0])
+        self.assertEqual(self.db.top('#test', 1), [('foo', 2)])
+        self.assertEqual(self.db.gets('#test', ['foo', 'bar', 'baz']),
+                         ([('foo', 2), ('bar', -1)], ['baz']))
+        self.assertEqual(self.db.rank('#test', 'bar'), 2)
+        self.assertRaises(ValueError, self.db.most, '#test', 'foo', 1)
+        self.assertEqual(self.db.stats('#test')['histogram'],
+                         [(-1, -1, 1), (0, 0, 0), (1, 1, 0), (2, 2, 1)])
+        # Channels are kept apart, as with the sqlite3 backend.
+        self.assertEqual(self.db.get('#other', 'foo'), None)
+
+    def testBytesSurvive(self):
+        name = 'caf\xe9\xff'
+        self.db.increment('#test', name)
+        self.assertEqual(self.db.top('#test', 1), [(name, 1)])
+
+    def testPipelining(self):
+        calls = [('karma.increment', ('#test', 'foo'))] * 50
+        calls.append(('karma.get', ('#test', 'foo')))
+        self.assertEqual(self.db.client.callMany(calls)[-1], [50, 0])
+
+    def testApplyChanges(self):
+        self.assertEqual(self.db.applyChanges('#test', [('foo', 1),
+                                                        ('foo', -1),
+                                                        ('bar', 2)]),
+                         [[1, 0], [1, 1], [2, 0]])
+        self.assertEqual(self.db.get('#test', 'foo'), None)
+
+    def testMalformedRequests(self):
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket)
+            sock.sendall('not json\n[1, 2]\n{"op": "karma.nosuch"}\n')
+            data = ''
+            while data.count('\n') < 3:
+                chunk = sock.recv(65536)
+                self.failUnless(chunk, 'karmad closed the connection')
+                data += chunk
+        finally:
+            sock.close()
+        responses = map(self.plugin.fromWire, data.splitlines())
+        self.assertEqual([r['message'] for r in responses],
+                         ['request is not JSON', 'request is not an object',
+                          "unknown op 'karma.nosuch'"])
+        self.assertEqual(self.daemon.poll(), None)
+        self.db.increment('#test', 'foo')
+        self.assertEqual(self.db.get('#test', 'foo'), [1, 0])
+
+    def testSharedBetweenClients(self):
+        other = self.plugin.KarmadClient(self.socket)
+        try:
+            other.call('karma.increment', '#test', 'foo')
+            self.assertEqual(self.db.get('#test', 'foo'), [1, 0])
+        finally:
+            other.close()
+
+    def testAliases(self):
+        self.aliases.alias('#test', 'bob', 'rob')
+        self.assertEqual(self.aliases.get('#test', 'rob'), ['bob'])
+        self.assertEqual(self.aliases.get_aliases('#test', 'bob'), ['rob'])
+        self.aliases.unalias('#test', 'bob', 'rob')
+        self.assertEqual(self.aliases.get('#test', 'rob'), [])
+
+class SqliteKarmaDBTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        import NewKarma.plugin
+        self.plugin = NewKarma.plugin
+        self.directory = conf.supybot.directories.data.dirize('#sqlite')
+        self.db = self.plugin.SqliteKarmaDB('Karma.sqlite3.db')
+
+    def tearDown(self):
+        self.db.close()
+        import shutil
+        shutil.rmtree(self.directory)
+        SupyTestCase.tearDown(self)
+
+    def testReadersSeeCommittedWrites(self):
+        self.db.increment('#sqlite', 'foo')
+        self.assertEqual(self.db.get('#sqlite', 'foo'), [1, 0])
+        self.db.increment('#sqlite', 'foo')
+        self.assertEqual(self.db.top('#sqlite', 1), [('foo', 2)])
+
+    def testDeferredWritesVisibleToWriter(self):
+        self.db.deferCommits = True
+        self.db.increment('#sqlite', 'foo')
+        self.assertEqual(self.db.get('#sqlite', 'foo'), [1, 0])
+        other = self.plugin.SqliteKarmaDB('Karma.sqlite3.db')
+        try:
+            # Another store reads the last committed snapshot rather than
+            # waiting on the open write transaction.
+            self.assertEqual(other.get('#sqlite', 'foo'), None)
+            self.db.flush()
+            self.assertEqual(other.get('#sqlite', 'foo'), [1, 0])
+        finally:
+            other.close()
+
+    def testThreadedReads(self):
+        import threading
+        self.db.increment('#sqlite', 'foo')
+        errors = []
+        def read():
+            try:
+                for _ in range(50):
+                    self.db.top('#sqlite', 5)
+                    self.db.most('#sqlite', 'active', 5)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=read) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for _ in range(50):
+            self.db.increment('#sqlite', 'foo')
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.db.get('#sqlite', 'foo'), [51, 0])
+        pool = self.db.readers.values()[0]
+        self.failUnless(pool.opened <= self.db.readerPoolSize)
+
+    def testMainThreadReadsThroughWriter(self):
+        import threading
+        self.db.increment('#sqlite', 'foo')
+        self.assertEqual(self.db.get('#sqlite', 'foo'), [1, 0])
+        # Busy readers can't keep the writer waiting for a connection.
+        self.assertEqual(self.db.readers.keys(), [])
+        results = []
+        t = threading.Thread(target=lambda:
+                             results.append(self.db.get('#sqlite', 'foo')))
+        t.start()
+        t.join()
+        self.assertEqual(results, [[1, 0]])
+        self.assertEqual(len(self.db.readers), 1)
+
+    def testThreadedStats(self):
+        import threading
+        self.db.loadRows('#sqlite', [('thing%s' % i, i % 7, i % 5)
+                                     for i in range(2000)])
+        filename = self.plugin.plugins.makeChannelFilename(self.db.filename,
+                                                           '#sqlite')
+        errors = []
+        def stats():
+            try:
+                self.db.stats('#sqlite')
+            except Exception, e:
+                errors.append(e)
+        for round in range(5):
+            self.db.distributions.pop(filename, None)
+            t = threading.Thread(target=stats)
+            t.start()
+            # Every write lands either in the snapshot the distribution is
+            # built from or in the distribution afterwards, never neither.
+            for i in range(200):
+                self.db.increment('#sqlite', 'new%s-%s' % (round, i))
+                self.db.decrement('#sqlite', 'thing%s' % i)
+            t.join()
+            self.assertEqual(errors, [])
+            totals = [added - subtracted for (_, added, subtracted)
+                      in self.db._query('#sqlite', """SELECT name, added,
+                                                      subtracted FROM karma""")]
+            expected = self.plugin.KarmaDistribution(totals).summary()
+            self.assertEqual(self.db.stats('#sqlite'), expected)
+
+    def testApplyChanges(self):
+        self.db.increment('#sqlite', 'bar')
+        self.db.stats('#sqlite')
+        commits = []
+        class Recorder(object):
+            def __init__(self, db):
+                self.db = db
+            def commit(self):
+                commits.append(True)
+                self.db.commit()
+            def __getattr__(self, attr):
+                return getattr(self.db, attr)
+        writer = self.db._getDb('#sqlite')
+        self.db.dbs[self.db.dbs.keys()[0]] = Recorder(writer)
+        results = self.db.applyChanges('#sqlite', [('Foo', 1), ('bar', -1),
+                                                   ('foo', 1), ('baz', -2),
+                                                   ('foo', -3)])
+        self.assertEqual(results, [[1, 0], [1, 1], [2, 0], [0, 2], [2, 3]])
+        self.assertEqual(len(commits), 1)
+        # bar came back to zero and was forgotten.
+        self.assertEqual(self.db.get('#sqlite', 'bar'), None)
+        self.assertEqual(self.db.get('#sqlite', 'foo'), [2, 3])
+        self.assertEqual(self.db.top('#sqlite', 1), [('Foo', -1)])
+        stats = self.db.stats('#sqlite')
+        self.assertEqual((stats['count'], stats['min'], stats['max']),
+                         (2, -2, -1))
+
+class KarmaDistributionTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        import NewKarma.plugin
+        self.plugin = NewKarma.plugin
+        self.directory = conf.supybot.directories.data.dirize('#stats')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory, True)
+        SupyTestCase.tearDown(self)
+
+    def assertConsistent(self, db):
+        # Recompute everything from a full scan and compare.
+        totals = sorted([t for (_, t) in db.top('#stats', db.size('#stats'))])
+        stats = db.stats('#stats')
+        self.assertEqual(stats['count'], len(totals))
+        if not totals:
+            return
+        self.assertEqual(stats['min'], totals[0])
+        self.assertEqual(stats['max'], totals[-1])
+        mean = float(sum(totals)) / len(totals)
+        self.failUnless(abs(stats['mean'] - mean) < 1e-9)
+        variance = sum([(t - mean) ** 2 for t in totals]) / len(totals)
+        self.failUnless(abs(stats['stddev'] - variance ** 0.5) < 1e-6)
+        import math
+        for (p, total) in stats['percentiles']:
+            rank = max(int(math.ceil(p / 100.0 * len(totals))), 1)
+            self.assertEqual(total, totals[rank-1])
+        self.assertEqual(stats['median'],
+                         totals[max(int(math.ceil(len(totals) / 2.0)), 1)-1])
+        self.assertEqual(sum([c for (_, _, c) in stats['histogram']]),
+                         len(totals))
+        for (low, high, count) in stats['histogram']:
+            self.assertEqual(count,
+                             len([t for t in totals if low <= t <= high]))
+
+    def exercise(self, db):
+        import random
+        r = random.Random(42)
+        self.assertConsistent(db)
+        names = ['thing%s' % i for i in range(40)]
+        for i in range(1500):
+            name = r.choice(names)
+            op = r.random()
+            if op < 0.55:
+                db.increment('#stats', name)
+            elif op < 0.9:
+                db.decrement('#stats', name)
+            elif op < 0.95:
+                db.clear('#stats', name)
+            else:
+                db.garbageCollect('#stats', name)
+            if i % 250 == 0:
+                self.assertConsistent(db)
+        self.assertConsistent(db)
+        db.dump('#stats', 'stats.csv')
+        db.increment('#stats', 'extra')
+        db.load('#stats', 'stats.csv')
+        self.assertConsistent(db)
+
+    def testSqlite(self):
+        db = self.plugin.SqliteKarmaDB('Karma.sqlite3.db')
+        try:
+            self.exercise(db)
+        finally:
+            db.close()
+
+    def testJournal(self):
+        db = self.plugin.JournalKarmaDB('Karma.journal.db')
+        try:
+            self.exercise(db)
+        finally:
+            db.close()
+
+    def testQuantiles(self):
+        d = self.plugin.KarmaDistribution([5, 1, 3, 3, -2])
+        self.assertEqual(d.quantile(0), -2)
+        self.assertEqual(d.quantile(0.5), 3)
+        self.assertEqual(d.quantile(1), 5)
+        self.assertEqual(d.histogram(4), [(-2, -1, 1), (0, 1, 1),
+                                          (2, 3, 2), (4, 5, 1)])
+        d.change(5, None)
+        d.change(None, 7)
+        d.change(-2, 0)
+        self.assertEqual(d.quantile(0), 0)
+        self.assertEqual(d.summary()['max'], 7)
+
+class KarmaLimiterTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        import NewKarma.plugin
+        self.limiter = NewKarma.plugin.KarmaLimiter()
+        self.limits = [('nick', 60.0, 2), ('target', 60.0, 3),
+                       ('channel', 0.0, 50)]
+
+    def testBurstThenRefill(self):
+        check = self.limiter.check
+        self.assertEqual(check('#test', self.limits, nick='foo', now=0), None)
+        self.assertEqual(check('#test', self.limits, nick='FOO', now=0), None)
+        self.assertEqual(check('#test', self.limits, nick='foo', now=0),
+                         'nick')
+        # One token a second at 60 a minute.
+        self.assertEqual(check('#test', self.limits, nick='foo', now=1), None)
+        self.assertEqual(check('#test', self.limits, nick='foo', now=1),
+                         'nick')
+
+    def testTargetLimitSpansNicks(self):
+        check = self.limiter.check
+        for _ in range(3):
+            self.assertEqual(check('#test', self.limits, target='Bar', now=0),
+                             None)
+        self.assertEqual(check('#test', self.limits, target='bar', now=0),
+                         'target')
+        self.assertEqual(check('#other', self.limits, target='bar', now=0),
+                         None)
+
+    def testRejectedChangeTakesNoTokens(self):
+        check = self.limiter.check
+        # Ten tokens a second for the channel, one for the nick.
+        limits = [('nick', 60.0, 2), ('channel', 600.0, 1)]
+        self.assertEqual(check('#test', limits, nick='foo', now=0), None)
+        for _ in range(10):
+            self.assertEqual(check('#test', limits, nick='foo', now=0),
+                             'channel')
+        self.assertEqual(check('#test', limits, nick='foo', now=0.1), None)
+        self.assertEqual(check('#test', limits, nick='foo', now=0.2), 'nick')
+
+    def testCounters(self):
+        for _ in range(3):
+            self.limiter.check('#test', self.limits, nick='foo', now=0)
+        for _ in range(2):
+            self.limiter.check('#test', self.limits, target='bar', now=0)
+        counters = self.limiter.counters['#TEST']
+        self.assertEqual(counters['allowed'], 2)
+        self.assertEqual(counters['nick'], 1)
+
+    def testPrune(self):
+        self.limiter.maxBuckets = 10
+        for i in range(20):
+            self.limiter.check('#test', self.limits, nick='n%s' % i, now=i)
+        self.failUnless(len(self.limiter.buckets) <= 10)
+
+    def testPruneDuringFlood(self):
+        self.limiter.maxBuckets = 10
+        prunes = []
+        prune = self.limiter._prune
+        def countingPrune(now):
+            prunes.append(now)
+            prune(now)
+        self.limiter._prune = countingPrune
+        # None of these buckets refill, so none can be pruned.
+        for i in range(1000):
+            self.limiter.check('#test', self.limits, nick='n%s' % i, now=0)
+        self.assertEqual(len(self.limiter.buckets), 1000)
+        self.failUnless(len(prunes) < 10, prunes)
+
+
+class AliasClosureTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        import NewKarma.plugin
+        self.plugin = NewKarma.plugin
+
+    def testChains(self):
+        closure = self.plugin.AliasClosure([('bob', 'rob'), ('rob', 'bobby'),
+                                            ('Bob', 'R')])
+        self.assertEqual(closure.resolve('rob'), ('bob',))
+        self.assertEqual(closure.resolve('BOBBY'), ('bob',))
+        self.assertEqual(closure.resolve('r'), ('bob',))
+        self.assertEqual(closure.resolve('bob'), ())
+
+    def testGroups(self):
+        closure = self.plugin.AliasClosure([('alice', 'devs'),
+                                            ('bob', 'devs'),
+                                            ('devs', 'everyone'),
+                                            ('carol', 'everyone')])
+        self.assertEqual(closure.resolve('devs'), ('alice', 'bob'))
+        self.assertEqual(closure.resolve('everyone'),
+                         ('alice', 'bob', 'carol'))
+
+    def testCycles(self):
+        closure = self.plugin.AliasClosure()
+        self.assertEqual(closure.setTargets('rob', ['bob']), [])
+        self.assertEqual(closure.setTargets('bob', ['rob']),
+                         [['bob', 'rob']])
+        self.assertEqual(closure.resolve('rob'), ('bob',))
+        self.assertEqual(closure.resolve('bob'), ('rob',))
+        # A way out of the cycle is followed instead.
+        closure.setTargets('rob', ['bob', 'robert'])
+        self.assertEqual(closure.resolve('bob'), ('robert',))
+        self.assertEqual(closure.resolve('rob'), ('robert',))
+        closure.setTargets('me', ['me'])
+        self.assertEqual(closure.resolve('me'), ())
+
+    def testIncrementalMatchesRebuild(self):
+        import random
+        r = random.Random(7)
+        names = ['n%s' % i for i in range(12)]
+        closure = self.plugin.AliasClosure()
+        edges = {}
+        for _ in range(300):
+            alias = r.choice(names)
+            targets = r.sample(names, r.randrange(3))
+            edges[alias] = targets
+            closure.setTargets(alias, targets)
+            pairs = [(name, a) for (a, L) in edges.items() for name in L]
+            rebuilt = self.plugin.AliasClosure(pairs)
+            self.assertEqual(closure.closure, rebuilt.closure)
+
+    def testDeepChain(self):
+        pairs = [('n%s' % i, 'n%s' % (i+1)) for i in range(5000)]
+        closure = self.plugin.AliasClosure(pairs)
+        self.assertEqual(closure.resolve('n5000'), ('n0',))
+
+class SqliteAliasDBTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        import NewKarma.plugin
+        self.plugin = NewKarma.plugin
+        self.directory = conf.supybot.directories.data.dirize('#aliases')
+        self.db = NewKarma.plugin.SqliteAliasDB('KarmaAliases.sqlite3.db')
+
+    def tearDown(self):
+        self.db.close()
+        import shutil
+        shutil.rmtree(self.directory)
+        SupyTestCase.tearDown(self)
+
+    def testIncrementalMatchesRebuild(self):
+        self.db.alias('#aliases', 'y', 'axb')
+        self.db.alias('#aliases', 'x', 'a_b')
+        self.db.alias('#aliases', 'z', 'A%B')
+        self.db.alias('#aliases', 'w', 'Axb')
+        for alias in ('a_b', 'axb', 'a%b'):
+            rebuilt = self.plugin.AliasClosure(self.db.pairs('#aliases'))
+            self.assertEqual(self.db.get('#aliases', alias),
+                             list(rebuilt.resolve(alias)))
+        self.assertEqual(self.db.get('#aliases', 'a_b'), ['x'])
+        self.assertEqual(self.db.get('#aliases', 'AXB'), ['w', 'y'])
+        self.db.unalias('#aliases', 'y', 'axb')
+        self.assertEqual(self.db.get('#aliases', 'axb'), ['w'])
+
+    def testGet(self):
+        self.db.alias('#aliases', 'Bob', 'rob')
+        self.db.alias('#aliases', 'rob', 'Robby')
+        self.assertEqual(self.db.get('#aliases', 'robby'), ['bob'])
+        self.assertEqual(self.db.get_aliases('#aliases', 'bob'), ['rob'])
+        self.db.unalias('#aliases', 'bob', 'rob')
+        self.assertEqual(self.db.get('#aliases', 'robby'), ['rob'])
+        self.db.dump('#aliases', 'aliases.csv')
+        self.db.alias('#aliases', 'carol', 'rob')
+        self.assertEqual(self.db.get('#aliases', 'robby'), ['carol'])
+        self.db.load('#aliases', 'aliases.csv')
+        self.assertEqual(self.db.get('#aliases', 'robby'), ['rob'])
+
+class RebuildTestCase(SupyTestCase):
+    logs = [
+        ['2015-11-10T12:00:00  *** alice <a@host> has joined #test',
+         '2015-11-10T12:00:01  <alice> foo++ bar++',
+         '2015-11-10T12:00:02  <bob> foo++ and (baz)--',
+         '2015-11-10T12:00:03  <alice> alice++',
+         '2015-11-10T12:00:04  <carol> alice is also known as ally',
+         '2015-11-10T12:00:05  * carol waves'],
+        ['2015-11-11T12:00:00  <bob> ally++',
+         '2015-11-11T12:00:01  <bob> test: quux++',
+         '2015-11-11T12:00:02  <bob> test: quux++ is great',
+         '2015-11-11T12:00:03  <alice> bar--',
+         '2015-11-11T12:00:04  *** x--y <x@host> has joined #test',
+         '2015-11-11T12:00:05  <alice> x--y is here'],
+    ]
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        import tempfile
+        import NewKarma.rebuild
+        self.rebuild = NewKarma.rebuild
+        self.directory = tempfile.mkdtemp()
+        self.filenames = []
+        for (i, lines) in enumerate(self.logs):
+            filename = os.path.join(self.directory, '#test.%s.log' % i)
+            fd = file(filename, 'w')
+            fd.write('\n'.join(lines) + '\n')
+            fd.close()
+            self.filenames.append(filename)
+        self.options = self.rebuild.Options('test', True)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+        SupyTestCase.tearDown(self)
+
+    def scan(self, checkpoint=None):
+        import StringIO
+        out = StringIO.StringIO()
+        results = self.rebuild.scanAll(self.filenames, self.options, 2,
+                                       self.rebuild.Checkpoint(checkpoint),
+                                       out=out)
+        return (results, out.getvalue())
+
+    def testRebuild(self):
+        (results, _) = self.scan()
+        (rows, aliases) = self.rebuild.merge(results)
+        self.assertEqual(sorted(rows), [('alice', 1, 0), ('baz', 0, 1),
+                                        ('foo', 2, 0), ('quux', 1, 0)])
+        self.assertEqual(aliases, [('alice', 'ally')])
+        (rows, _) = self.rebuild.merge(results, allowSelfRating=True)
+        self.failUnless(('alice', 2, 0) in rows)
+
+    def testCheckpoint(self):
+        checkpoint = os.path.join(self.directory, 'checkpoint')
+        (first, out) = self.scan(checkpoint)
+        self.failIf('Resuming' in out)
+        (second, out) = self.scan(checkpoint)
+        self.failUnless('Resuming: 2 of 2' in out)
+        self.assertEqual(first, second)
+        fd = file(self.filenames[1], 'a')
+        fd.write('2015-11-12T12:00:00  <bob> foo++\n')
+        fd.close()
+        (third, out) = self.scan(checkpoint)
+        self.failUnless('Resuming: 1 of 2' in out)
+        self.assertEqual(self.rebuild.merge(third)[0].count(('foo', 3, 0)), 1)
+
+    def testLoadRows(self):
+        import NewKarma.plugin
+        (rows, aliases) = self.rebuild.merge(self.scan()[0])
+        db = NewKarma.plugin.SqliteKarmaDB('Karma.sqlite3.db')
+        try:
+            db.increment('#rebuild', 'stale')
+            db.loadRows('#rebuild', rows)
+            self.assertEqual(db.get('#rebuild', 'stale'), None)
+            self.assertEqual(db.get('#rebuild', 'foo'), [2, 0])
+        finally:
+            db.close()
+            import shutil
+            shutil.rmtree(conf.supybot.directories.data.dirize('#rebuild'))
+
+class KarmaTableTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        import NewKarma.plugin
+        self.table = NewKarma.plugin.KarmaTable()
+
+    def testSetAndFind(self):
+        slot = self.table.set('Foo', 3, 1)
+        self.assertEqual(self.table.find('FOO'), slot)
+        self.assertEqual(self.table.names[slot], 'Foo')
+        self.assertEqual(self.table.total(slot), 2)
+        self.assertEqual(self.table.set('foo', 5), slot)
+        self.assertEqual(list(self.table.rows()), [('foo', 5, 0)])
+        self.assertEqual(self.table.find('bar'), None)
+
+    def testLowercaseNameSharesKey(self):
+        name = 'bar'.upper().lower()
+        slot = self.table.set(name)
+        (key,) = self.table.index.keys()
+        self.failUnless(self.table.names[slot] is key)
+
+    def testRemoveReusesSlot(self):
+        foo = self.table.set('foo', 1)
+        self.table.set('bar', 2)
+        self.table.remove(foo)
+        self.assertEqual(self.table.find('foo'), None)
+        self.assertEqual(len(self.table), 1)
+        self.assertEqual(self.table.set('baz', 3), foo)
+        self.assertEqual(len(self.table.names), 2)
+        self.assertEqual(sorted(self.table.rows()),
+                         [('bar', 2, 0), ('baz', 3, 0)])
+
+
+class JournalKarmaDBTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        import NewKarma.plugin
+        self.plugin = NewKarma.plugin
+        self.directory = conf.supybot.directories.data.dirize('#journal')
+        self.db = self.plugin.JournalKarmaDB('Karma.journal.db')
+
+    def tearDown(self):
+        self.db.close()
+        import shutil
+        shutil.rmtree(self.directory)
+        SupyTestCase.tearDown(self)
+
+    def reopen(self):
+        self.db.close()
+        self.db = self.plugin.JournalKarmaDB('Karma.journal.db')
+
+    def testInterface(self):
+        db = self.db
+        self.assertEqual(db.get('#journal', 'foo'), None)
+        for _ in range(3):
+            db.increment('#journal', 'Foo')
+        db.increment('#journal', 'bar')
+        db.decrement('#journal', 'bar')
+        db.decrement('#journal', 'baz')
+        self.assertEqual(db.get('#journal', 'foo'), [3, 0])
+        self.assertEqual(db.gets('#journal', ['foo', 'baz', 'quux']),
+                         ([('Foo', 3), ('baz', -1)], ['quux']))
+        self.assertEqual(db.top('#journal', 1), [('Foo', 3)])
+        self.assertEqual(db.bottom('#journal', 1), [('baz', -1)])
+        self.assertEqual(db.rank('#journal', 'baz'), 3)
+        self.assertEqual(db.size('#journal'), 3)
+        self.assertEqual(db.most('#journal', 'active', 1), [('Foo', 3)])
+        self.assertRaises(ValueError, db.most, '#journal', 'foo', 1)
+        db.clear('#journal', 'foo')
+        self.assertEqual(db.get('#journal', 'foo'), [0, 0])
+        db.garbageCollect('#journal', 'foo')
+        self.assertEqual(db.get('#journal', 'foo'), None)
+        db.dump('#journal', 'karma.csv')
+        db.increment('#journal', 'bar')
+        db.load('#journal', 'karma.csv')
+        self.assertEqual(db.get('#journal', 'bar'), [1, 1])
+        self.assertEqual(db.size('#journal'), 2)
+
+    def testApplyChanges(self):
+        self.db.increment('#journal', 'bar')
+        journal = self.db._getDb('#journal')
+        writes = []
+        realWrite = journal.write
+        def write(entries):
+            writes.append(entries)
+            realWrite(entries)
+        journal.write = write
+        results = self.db.applyChanges('#journal', [('Foo', 1), ('bar', -1),
+                                                    ('foo', 1), ('baz', -2)])
+        self.assertEqual(results, [[1, 0], [1, 1], [2, 0], [0, 2]])
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(self.db.get('#journal', 'bar'), None)
+        self.reopen()
+        self.assertEqual(self.db.get('#journal', 'foo'), [2, 0])
+        self.assertEqual(self.db.get('#journal', 'baz'), [0, 2])
+        self.assertEqual(self.db.get('#journal', 'bar'), None)
+
+    def testThreadedReads(self):
+        import threading
+        for i in range(1000):
+            self.db.increment('#journal', 'thing%s' % i)
+        errors = []
+        done = threading.Event()
+        def read():
+            try:
+                while not done.isSet():
+                    self.db.top('#journal', 5)
+                    self.db.most('#journal', 'active', 5)
+                    self.db.rank('#journal', 'thing0')
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for t in threads:
+            t.start()
+        try:
+            # New things grow the records while the readers walk them.
+            for i in range(1000, 5000):
+                self.db.increment('#journal', 'thing%s' % i)
+        finally:
+            done.set()
+            for t in threads:
+                t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.db.size('#journal'), 5000)
+
+    def testReplay(self):
+        self.db.increment('#journal', 'foo')
+        self.db.increment('#journal', 'foo')
+        self.db.decrement('#journal', 'bar')
+        # Drop the store without closing it, as a crash would.
+        self.db = self.plugin.JournalKarmaDB('Karma.journal.db')
+        self.assertEqual(self.db.get('#journal', 'foo'), [2, 0])
+        self.assertEqual(self.db.get('#journal', 'bar'), [0, 1])
+        self.reopen()
+        self.assertEqual(self.db.get('#journal', 'foo'), [2, 0])
+
+    def testCompaction(self):
+        journal = self.db._getDb('#journal')
+        journal.compactEvery = 10
+        for _ in range(25):
+            self.db.increment('#journal', 'foo')
+        self.assertEqual(journal.generation, 2)
+        self.assertEqual(journal.entries, 5)
+        self.reopen()
+        self.assertEqual(self.db.get('#journal', 'foo'), [25, 0])
+
+    def testStaleJournalIgnored(self):
+        self.db.increment('#journal', 'foo')
+        journal = self.db._getDb('#journal')
+        stale = file(journal.journalFilename).read()
+        self.reopen()
+        # A crash after the snapshot was written but before the journal was
+        # truncated leaves the old journal behind.
+        fd = file(journal.journalFilename, 'wb')
+        fd.write(stale)
+        fd.close()
+        self.db = self.plugin.JournalKarmaDB('Karma.journal.db')
+        self.assertEqual(self.db.get('#journal', 'foo'), [1, 0])
+
+    def testTornAppendIgnored(self):
+        self.db.increment('#journal', 'foo')
+        journal = self.db._getDb('#journal')
+        journal.journal.write('+,fo')
+        journal.journal.flush()
+        self.db = self.plugin.JournalKarmaDB('Karma.journal.db')
+        self.assertEqual(self.db.get('#journal', 'foo'), [1, 0])
+        self.assertEqual(self.db.get('#journal', 'fo'), None)
+        # The torn line is gone, so appending again after the first reopen
+        # doesn't finish it.
+        self.db.increment('#journal', 'foo')
+        self.db = self.plugin.JournalKarmaDB('Karma.journal.db')
+        self.assertEqual(self.db.get('#journal', 'foo'), [2, 0])
+        self.assertEqual(self.db.get('#journal', 'fo'), None)
+
+    def testMalformedRowsIgnored(self):
+        self.db.increment('#journal', 'foo')
+        journal = self.db._getDb('#journal')
+        journal.journal.write('+,fo+,foo\nx,bar\n')
+        journal.journal.flush()
+        self.db.increment('#journal', 'foo')
+        self.db = self.plugin.JournalKarmaDB('Karma.journal.db')
+        self.assertEqual(self.db.get('#journal', 'foo'), [2, 0])
+        self.assertEqual(self.db.get('#journal', 'bar'), None)
+
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: